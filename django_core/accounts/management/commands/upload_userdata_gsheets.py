@@ -2,7 +2,7 @@ from django.core.management import BaseCommand
 from tqdm import tqdm
 
 from helpers.google_sheets import GoogleSheetsConnection, GoogleSheetsAdapter
-from helpers.course_tree import CourseLessonsTree
+from helpers.course_tree import get_course_tree
 from accounts.models import Profile
 from lessons.models import Course, Branching
 
@@ -15,7 +15,7 @@ class Command(BaseCommand):
         users_data = []
         course = Course.objects.first()
         profiles = Profile.objects.filter(course=course, user__isnull=False).all()
-        course_tree = CourseLessonsTree(course)
+        course_tree = get_course_tree(course.id)
 
         with tqdm(total=len(profiles), ncols=100) as pbar:
             for id_, profile in enumerate(profiles, start=1):
@@ -0,0 +1,25 @@
+from django.utils.functional import SimpleLazyObject
+
+from accounts.models import Profile
+
+
+def get_request_profile(request) -> Profile:
+    return (
+        Profile.objects
+        .select_related("user", "resources", "statistics", "scientific_director")
+        .get(user=request.user, course_id=1)
+    )
+
+
+class RequestProfileMiddleware:
+    """
+        Профиль игрока доступен как request.profile и загружается один раз за запрос.
+        Загрузка ленивая: пользователь из JWT известен только после аутентификации DRF
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.profile = SimpleLazyObject(lambda: get_request_profile(request))
+        return self.get_response(request)
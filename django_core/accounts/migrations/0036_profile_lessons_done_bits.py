@@ -0,0 +1,23 @@
+# Generated by Django 3.1.7 on 2026-10-17 15:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0035_auto_20240407_1733'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='lessons_done_bits',
+            field=models.BinaryField(default=bytes),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='lessons_done_version',
+            field=models.CharField(default='', editable=False, max_length=32),
+        ),
+    ]
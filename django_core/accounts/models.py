@@ -20,8 +20,8 @@ from accounts.choices import (
     LABORATORIES,
     LANGUAGES
 )
-from resources.models import Resources
-from resources.utils import get_max_energy_by_position
+from resources.models import Resources, ResourcesEventReason
+from resources.utils import get_max_energy_by_position, change_resources
 
 
 class UserRole(models.Model):
@@ -315,6 +315,10 @@ class Profile(LifecycleModel):
     language = models.CharField(max_length=8, choices=LANGUAGES, default="ru")
     all_tasks_correct = models.BooleanField(default=False)
 
+    # пройденные уроки курса битовой маской (см. helpers.course_tree.LessonsBitset)
+    lessons_done_bits = models.BinaryField(default=bytes, editable=False)
+    lessons_done_version = models.CharField(max_length=32, default="", editable=False)
+
     @hook(AFTER_CREATE)
     def create_related_entities(self) -> None:
         Resources.objects.create(
@@ -327,8 +331,8 @@ class Profile(LifecycleModel):
     @hook(AFTER_UPDATE, when="university_position", has_changed=True)
     def update_energy_on_university_position_change(self):
         max_energy = get_max_energy_by_position(self.university_position)
-        self.resources.set_energy(max_energy)
-        self.resources.save()
+        change_resources(self.id, ResourcesEventReason.POSITION, min_energy=max_energy)
+        self.resources.refresh_from_db(fields=["energy_amount"])
 
     @hook(BEFORE_UPDATE, when="scientific_director", has_changed=True, is_now=None)
     def set_scientific_director_by_default(self) -> None:
@@ -345,8 +349,11 @@ class Profile(LifecycleModel):
         if check_ultimate_is_active(self):
             return
 
-        self.resources.energy_amount -= settings.CHANGE_SCIENTIFIC_DIRECTOR_ENERGY_COST
-        self.resources.save()
+        change_resources(
+            self.id, ResourcesEventReason.SCIENTIFIC_DIRECTOR,
+            energy=-settings.CHANGE_SCIENTIFIC_DIRECTOR_ENERGY_COST
+        )
+        self.resources.refresh_from_db(fields=["energy_amount"])
 
     class Meta:
         app_label = "accounts"
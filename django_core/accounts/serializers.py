@@ -12,9 +12,10 @@ from accounts.models import (
     ProfileAvatarHair
 )
 from accounts.tasks import generate_profile_images
-from resources.utils import check_ultimate_is_active
+from resources.utils import check_ultimate_is_active, refill_energy
+from helpers.course_tree import get_course_tree, ProfileCourseProgress
 from lessons.exceptions import NPCIsNotScientificDirectorException, FirstScientificDirectorIsNotDefaultException
-from lessons.models import NPC, ProfileLessonDone
+from lessons.models import NPC
 from resources.exceptions import NegativeResourcesException, NotEnoughEnergyException
 from resources.serializers import EmotionDataSerializer
 
@@ -39,14 +40,12 @@ class ProfileStatisticsSerializer(serializers.ModelSerializer):
         return statistics.profile.tasks_done.filter(is_correct=True).count()
 
     def get_lessons_done(self, statistics: Statistics) -> int:
-        return ProfileLessonDone.objects.filter(profile=statistics.profile).count()
+        # все пройденные уроки, в том числе вне скомпилированного курса профиля
+        return statistics.profile.lessons_done.count()
 
     def get_quests_done(self, statistics: Statistics) -> int:
-        return ProfileLessonDone.objects.filter(
-            profile=statistics.profile,
-            lesson__next__in=["", "-1"],
-            lesson__quest__isnull=False
-        ).count()
+        course_tree = get_course_tree(statistics.profile.course_id)
+        return len(ProfileCourseProgress(statistics.profile).done_lessons & course_tree.quest_final_lessons)
 
     class Meta:
         model = Statistics
@@ -116,7 +115,7 @@ class ProfileSerializer(serializers.ModelSerializer):
     def _is_enough_energy_to_change_scientific_director(self, instance: Profile) -> bool:
         return (
             check_ultimate_is_active(instance)
-            or instance.resources.energy_amount >= settings.CHANGE_SCIENTIFIC_DIRECTOR_ENERGY_COST
+            or refill_energy(instance.resources).energy_amount >= settings.CHANGE_SCIENTIFIC_DIRECTOR_ENERGY_COST
         )
 
     def _update_scientific_director(self, profile: Profile, data: dict) -> None:
@@ -0,0 +1,36 @@
+from django.contrib.auth import get_user_model
+from django.http import HttpResponse
+from django.test import TestCase, RequestFactory
+
+from accounts.middleware import RequestProfileMiddleware
+from accounts.models import Profile
+from lessons.models import Course
+
+User = get_user_model()
+
+
+class RequestProfileMiddlewareTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = Course.objects.create(name="test", description="test")
+        # bulk_create не вызывает хуки, профиль создается явно
+        User.objects.bulk_create([User(username="test1", email="test1@mail.ru")])
+        cls.user = User.objects.get(username="test1")
+        cls.profile = Profile.objects.create(user=cls.user, course=cls.course)
+
+    def _get_profile(self, request):
+        request.loaded_profile = request.profile
+        return HttpResponse()
+
+    def test_profile_is_loaded_once_with_related_entities(self) -> None:
+        request = RequestFactory().get("/")
+        request.user = self.user
+
+        with self.assertNumQueries(0):
+            RequestProfileMiddleware(self._get_profile)(request)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(request.profile.id, self.profile.id)
+            self.assertEqual(request.profile.resources.id, self.profile.resources.id)
+            self.assertEqual(request.profile.statistics.id, self.profile.statistics.id)
+            self.assertIsNone(request.profile.scientific_director)
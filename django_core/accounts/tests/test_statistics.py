@@ -0,0 +1,31 @@
+from django.test import TestCase
+
+from accounts.models import Profile
+from accounts.serializers import ProfileStatisticsSerializer
+from lessons.models import Course, Lesson, LessonBlock, ProfileLessonDone
+
+
+class ProfileStatisticsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = Course.objects.create(name="test", description="test", entry="l_001")
+        cls.other_course = Course.objects.create(name="other", description="other")
+        cls.profile = Profile.objects.create(course=cls.course)
+
+        cls.lesson = cls._create_lesson(cls.course, "l_001")
+        cls.other_lesson = cls._create_lesson(cls.other_course, "l_002")
+
+    @staticmethod
+    def _create_lesson(course: Course, local_id: str) -> Lesson:
+        return Lesson.objects.create(
+            course=course, local_id=local_id, name=f"{local_id}_name", description="fixture",
+            time_cost=0, money_cost=0, energy_cost=0, content=LessonBlock.objects.create()
+        )
+
+    def test_lessons_done_are_counted_outside_of_course(self) -> None:
+        ProfileLessonDone.objects.bulk_create([
+            ProfileLessonDone(profile=self.profile, lesson=self.lesson),
+            ProfileLessonDone(profile=self.profile, lesson=self.other_lesson),
+        ])
+
+        self.assertEqual(ProfileStatisticsSerializer(instance=self.profile.statistics).data["lessons_done"], 2)
@@ -63,7 +63,7 @@ class ProfileViewSet(
         return Response( status=status.HTTP_200_OK)
 
     def get_object(self):
-        return self.request.user.profile.get(course_id=1)
+        return self.request.profile
 
     @swagger_auto_schema(**SwaggerFactory()(
         responses=[
@@ -96,7 +96,7 @@ class ProfileStatisticsViewSet(viewsets.GenericViewSet):
 
     @decorators.action(methods=["GET"], detail=False, url_path="statistics")
     def retrieve_statistics(self, request: Request, *args: tuple, **kwargs: dict) -> Response:
-        profile_statistics = request.user.profile.get(course_id=1).statistics
+        profile_statistics = request.profile.statistics
         serializer: ProfileStatisticsSerializer = self.get_serializer(instance=profile_statistics)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -105,7 +105,7 @@ class ProfileStatisticsViewSet(viewsets.GenericViewSet):
     ))
     @decorators.action(methods=["PATCH"], detail=False, url_path="statistics/update")
     def update_statistics(self, request: Request, *args: tuple, **kwargs: dict) -> Response:
-        profile_statistics = request.user.profile.get(course_id=1).statistics
+        profile_statistics = request.profile.statistics
         serializer: ProfileStatisticsUpdateSerializer = self.get_serializer(
             instance=profile_statistics,
             data=request.data
@@ -189,7 +189,7 @@ class ProfileAlbumViewSet(viewsets.GenericViewSet):
 
     @decorators.action(methods=["GET"], detail=False, url_path="album")
     def get_profile_album(self, request: Request, *args: tuple, **kwargs: dict) -> Response:
-        profile = request.user.profile.get(course_id=1)
+        profile = request.profile
         serialized_data = self.get_serializer(profile).data
         serialized_data["statistics"]["lessons_done"] = 36  # FIXME: hardcode
         return Response(serialized_data, status=status.HTTP_200_OK)
@@ -197,7 +197,7 @@ class ProfileAlbumViewSet(viewsets.GenericViewSet):
 
 class ProfileCourseListApiView(views.APIView):
      def get(self, request):
-         profile = request.user.profile.get()
+         profile = request.profile
          course = profile.course
          return Response(CourseNameSerializer(course).data)
      
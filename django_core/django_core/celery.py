@@ -22,12 +22,16 @@ app.autodiscover_tasks()
 
 
 app.conf.beat_schedule = {
-    "refill_resources_every_night": {
-        "task": "resources.tasks.refill_resources",
-        "schedule": crontab(minute="0", hour="0")
-    },
     "upload_statistics_every_night": {
         "task": "accounts.tasks.upload_statistics",
         "schedule": crontab(minute="0", hour="0")
+    },
+    "deactivate_ultimates_every_hour": {
+        "task": "resources.tasks.deactivate_ultimates",
+        "schedule": crontab(minute="0")
+    },
+    "compact_resources_events_every_night": {
+        "task": "resources.tasks.compact_resources_events",
+        "schedule": crontab(minute="30", hour="0")
     }
 }
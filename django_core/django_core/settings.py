@@ -59,6 +59,7 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "accounts.middleware.RequestProfileMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "corsheaders.middleware.CorsMiddleware",
@@ -275,6 +276,11 @@ ULTIMATE_DURATION = 3 * 60 * 60  # секунды
 START_COURSE_DATE = datetime(day=1, month=9, year=2022)
 CHANGE_SCIENTIFIC_DIRECTOR_ENERGY_COST = 6
 DEFAULT_SCIENTIFIC_DIRECTOR_UID = "C4"  # Если не задан, то "" (пустая строка)
+COURSE_MAP_CACHE_SIZE = 5000  # карт профилей на процесс
+COURSE_MAP_CACHE_TTL = 30 * 60  # секунды
+LESSON_UNITS_CACHE_SIZE = 500  # скомпилированных уроков на процесс
+LESSON_UNITS_CACHE_TTL = 24 * 60 * 60  # секунды
+RESOURCES_EVENTS_COMPACT_AFTER_DAYS = 30  # журнал ресурсов старше этого сворачивается
 
 LOGGING_ROOT = Path(BASE_DIR, "logs")
 LOGGING_ROOT.mkdir(exist_ok=True)
@@ -2,6 +2,7 @@ import logging
 
 from typing import List, Dict, Iterable
 
+from django.db import transaction
 from rest_framework import serializers
 from rest_framework.validators import ValidationError
 from rest_framework.exceptions import PermissionDenied
@@ -48,6 +49,8 @@ from lessons.models import (
 from lessons.structures import LessonBlockType, BlockType
 from editors.models import Block, EditorSession
 from helpers.mixins import ChildAccessMixin
+from helpers.course_tree import invalidate_course_tree
+from helpers.lesson_tree import rebuild_lesson_units
 
 
 logger = logging.Logger(__file__)
@@ -422,6 +425,12 @@ class UnitListSerializer(serializers.ListSerializer):
         # TODO: как то сохранять или создавать новые версии (ревизии)
         Unit.objects.filter(local_id__in=lids_to_delete).delete()
 
+        lesson_ids = {instance.lesson_id for instance in instances}
+        lesson_ids.update(data['lesson'] for data in validated_datas)
+
+        for lesson_id in lesson_ids:
+            rebuild_lesson_units(lesson_id)
+
         return ret
 
 
@@ -653,6 +662,9 @@ class LessonContentSerializer(serializers.ModelSerializer):
         instance = super().update(instance, validated_data)
         instance.save()
 
+        for lesson_id in Lesson.objects.filter(content=instance).values_list('id', flat=True):
+            rebuild_lesson_units(lesson_id)
+
         return instance
 
     class Meta:
@@ -771,6 +783,9 @@ class LessonSerializer(LisEditorModelSerializer):
         instance = super().update(instance, validated_data)
         instance.save()
 
+        course_id = instance.course_id
+        transaction.on_commit(lambda: invalidate_course_tree(course_id))
+
         return instance
 
     class Meta:
@@ -927,6 +942,11 @@ class QuestSerializer(LisEditorModelSerializer):
         self._update_lessons(instance, [], lessons_data)
         self._update_branchings(instance, [], branchings_data)
 
+        # bulk_update не отправляет сигналы: граф, собранный между сохранениями
+        # блоков и переносом их в квест, иначе остался бы под новой версией
+        course_id = instance.course_id
+        transaction.on_commit(lambda: invalidate_course_tree(course_id))
+
         return instance
 
     def update(self, instance, validated_data):
@@ -938,6 +958,9 @@ class QuestSerializer(LisEditorModelSerializer):
         self._update_lessons(instance, instance.lessons.all(), lessons_data)
         self._update_branchings(instance, instance.branchings.all(), branchings_data)
 
+        course_id = instance.course_id
+        transaction.on_commit(lambda: invalidate_course_tree(course_id))
+
         return instance
 
     class Meta:
@@ -1094,6 +1117,7 @@ class CourseSerializer(serializers.ModelSerializer):
         )
 
         instance.refresh_from_db()
+        transaction.on_commit(lambda: invalidate_course_tree(instance.id))
 
         return instance
 
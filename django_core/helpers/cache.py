@@ -0,0 +1,88 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, Hashable
+from uuid import uuid4
+
+from django.core.cache import cache
+
+
+_MISSING = object()
+
+
+def get_version(key: str) -> str:
+    """
+        Возвращает текущую версию сущности, хранящуюся в общем кэше.
+        Если версии еще нет, она создается атомарно (add)
+    """
+    version = cache.get(key)
+
+    if version is None:
+        cache.add(key, uuid4().hex, timeout=None)
+        version = cache.get(key)
+
+    return version
+
+
+def bump_version(key: str) -> str:
+    """
+        Инвалидирует все закэшированные данные сущности во всех процессах
+    """
+    version = uuid4().hex
+    cache.set(key, version, timeout=None)
+    return version
+
+
+class LRUCache:
+    """
+        Локальный (в пределах процесса) кэш ограниченного размера.
+        Давно не используемые записи вытесняются, устаревшие по ttl - не отдаются
+    """
+
+    def __init__(self, maxsize: int, ttl: int | None = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[Any, float | None]] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            value, expires_at = self._data.get(key, (_MISSING, None))
+
+            if value is _MISSING:
+                self.misses += 1
+                return default
+
+            if expires_at is not None and expires_at < monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires_at = monotonic() + self.ttl if self.ttl else None
+
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+    def __len__(self) -> int:
+        return len(self._data)
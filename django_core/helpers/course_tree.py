@@ -1,14 +1,74 @@
-from functools import lru_cache
+import hashlib
+import json
+from bisect import bisect_right
+from collections import namedtuple
+from functools import cached_property
+from threading import Lock
+
+from django.conf import settings
+from django.db.models import Q
 
 from accounts.models import Profile
 from lessons.models import (Lesson, Course, Quest, Branching, ProfileBranchingChoice,
                             ProfileLessonDone, CourseMapImg)
 from lessons.structures import BranchingType
 from helpers.abstract_tree import AbstractNode, AbstractNodeTree
+from helpers.cache import get_version, bump_version, LRUCache
 
 
 CourseBlockType = Lesson | Quest | Branching
 
+# Прогресс профиля по курсу:
+#   map_list - карта курса, positions - local_id -> индекс в карте,
+#   interacted - local_id пройденных уроков и выбранных ветвлений,
+#   active - индекс активного блока с учетом картинок карты
+CourseProgressSnapshot = namedtuple(
+    "CourseProgressSnapshot",
+    ("map_list", "positions", "interacted", "active")
+)
+
+# Размер карты квеста (блоков) и суммарная стоимость его уроков
+QuestSummary = namedtuple("QuestSummary", ("block_count", "money_cost"))
+
+
+class LessonsBitset:
+    """
+        Множество уроков курса в виде битовой маски по порядковым номерам уроков
+        в скомпилированном курсе (см. CourseLessonsTree.lesson_ordinals).
+        Уроки вне курса не учитываются
+    """
+
+    def __init__(self, ordinals: dict[int, int], bits: int = 0) -> None:
+        self.ordinals = ordinals
+        self.bits = bits
+
+    @classmethod
+    def from_bytes(cls, ordinals: dict[int, int], data: bytes) -> 'LessonsBitset':
+        return cls(ordinals, int.from_bytes(data, "little"))
+
+    def to_bytes(self) -> bytes:
+        return self.bits.to_bytes((len(self.ordinals) + 7) // 8, "little")
+
+    def add(self, lesson_id: int) -> None:
+        ordinal = self.ordinals.get(lesson_id)
+
+        if ordinal is not None:
+            self.bits |= 1 << ordinal
+
+    def __contains__(self, lesson_id: int) -> bool:
+        ordinal = self.ordinals.get(lesson_id)
+
+        if ordinal is None:
+            return False
+
+        return bool(self.bits >> ordinal & 1)
+
+    def __and__(self, other: 'LessonsBitset') -> 'LessonsBitset':
+        return LessonsBitset(self.ordinals, self.bits & other.bits)
+
+    def __len__(self) -> int:
+        return self.bits.bit_count()
+
 
 class CourseLessonNode(AbstractNode):
     def __init__(self, course_block: CourseBlockType, children: list['CourseLessonNode'] = None):
@@ -45,6 +105,12 @@ class CourseLessonNode(AbstractNode):
 
 
 class CourseLessonsTree(AbstractNodeTree):
+    """
+        Граф блоков курса (или квеста).
+        Для курса также строятся графы всех его квестов (quest_trees),
+        поэтому один экземпляр покрывает весь курс и может переиспользоваться
+        между запросами (см. get_course_tree)
+    """
     node_cls = CourseLessonNode
     tree_elements: dict[str, CourseLessonNode]
     tree: CourseLessonNode
@@ -52,22 +118,67 @@ class CourseLessonsTree(AbstractNodeTree):
     def __init__(
         self,
         entity: Course | Quest,
+        blocks: list[CourseBlockType] = None,
+        root: 'CourseLessonsTree' = None,
     ) -> None:
         self.entity = entity
+        self.root = root or self
+        self.version = None
 
-        blocks: list[CourseBlockType] = []
+        if blocks is None:
+            blocks = self._load_blocks(entity)
 
-        blocks.extend(list(entity.lessons.all()))
-        blocks.extend(list(entity.branchings.all()))
+        self.m_blocks = {b.local_id: b for b in blocks}
+        self.quest_trees: dict[str, CourseLessonsTree] = {}
+        self._summaries: dict[tuple, QuestSummary] = {}
 
         if isinstance(entity, Course):
-            blocks.extend(list(entity.quests.all()))
+            self._build_quest_trees(blocks)
 
-        self.m_blocks = {b.local_id: b for b in blocks}
         super().__init__()
 
-    def get_quest_number(self, profile: Profile, lesson: Lesson) -> int:
-        course_map = self.get_map_for_profile(profile)
+    @staticmethod
+    def _load_blocks(entity: Course | Quest) -> list[CourseBlockType]:
+        if isinstance(entity, Quest):
+            return [*entity.lessons.all(), *entity.branchings.all()]
+
+        return [
+            *entity.lessons.select_related("quest", "profile_affect"),
+            *Branching.objects.filter(Q(course=entity) | Q(quest__course=entity)).distinct(),
+            *entity.quests.all(),
+        ]
+
+    def _build_quest_trees(self, blocks: list[CourseBlockType]) -> None:
+        for quest in blocks:
+            if not isinstance(quest, Quest):
+                continue
+
+            quest_blocks = [
+                b for b in blocks
+                if not isinstance(b, Quest) and b.quest_id == quest.id
+            ]
+
+            # квест без входа не компилируем: он будет собран по запросу, как и раньше
+            if quest.entry not in {b.local_id for b in quest_blocks}:
+                continue
+
+            self.quest_trees[quest.local_id] = CourseLessonsTree(quest, quest_blocks, root=self)
+
+    def get_quest_tree(self, quest: Quest) -> 'CourseLessonsTree':
+        quest_tree = self.root.quest_trees.get(quest.local_id)
+
+        if quest_tree is None:
+            quest_tree = CourseLessonsTree(quest)
+
+        return quest_tree
+
+    def get_quest_number(
+        self,
+        profile: Profile,
+        lesson: Lesson,
+        progress: 'ProfileCourseProgress' = None,
+    ) -> int:
+        course_map = self.get_map_for_profile(profile, progress)
         quest_index = 0
         prev_quest_index = None
 
@@ -83,8 +194,13 @@ class CourseLessonsTree(AbstractNodeTree):
 
         return -1
 
-    def get_lesson_number(self, profile: Profile, lesson: Lesson) -> int:
-        course_map = self.get_map_for_profile(profile)
+    def get_lesson_number(
+        self,
+        profile: Profile,
+        lesson: Lesson,
+        progress: 'ProfileCourseProgress' = None,
+    ) -> int:
+        course_map = self.get_map_for_profile(profile, progress)
         lesson_index = 0
 
         for course_map_cell in course_map:
@@ -102,8 +218,114 @@ class CourseLessonsTree(AbstractNodeTree):
     def _get_element_by_id(self, element_id: str):
         return self.m_blocks[element_id]
 
-    @lru_cache
-    def get_max_depth(self):
+    def get_max_depth(self) -> int:
+        return self.max_depth
+
+    @cached_property
+    def map_images(self) -> tuple[CourseMapImg, ...]:
+        """
+            Картинки карты курса, загружаются один раз вместе с графом курса
+        """
+        return tuple(CourseMapImg.objects.filter(course_id=self.entity.id).order_by("order", "id"))
+
+    @cached_property
+    def map_image_orders(self) -> list[int]:
+        return [image.order for image in self.map_images]
+
+    @cached_property
+    def lesson_ordinals(self) -> dict[int, int]:
+        """
+            Плотные порядковые номера уроков курса для LessonsBitset, одинаковые во всех процессах
+        """
+        lesson_ids = sorted(b.id for b in self.root.m_blocks.values() if isinstance(b, Lesson))
+        return {lesson_id: ordinal for ordinal, lesson_id in enumerate(lesson_ids)}
+
+    @cached_property
+    def lesson_ordinals_version(self) -> str:
+        """
+            Версия порядковых номеров: меняется только при добавлении или удалении уроков курса
+        """
+        lesson_ids = ",".join(map(str, self.root.lesson_ordinals))
+        return hashlib.md5(lesson_ids.encode()).hexdigest()
+
+    @cached_property
+    def quest_final_lessons(self) -> LessonsBitset:
+        """
+            Последние уроки квестов: пройденный последний урок - пройденный квест
+        """
+        quest_final_lessons = LessonsBitset(self.root.lesson_ordinals)
+
+        for block in self.root.m_blocks.values():
+            if isinstance(block, Lesson) and block.quest_id is not None and block.next in ("", "-1"):
+                quest_final_lessons.add(block.id)
+
+        return quest_final_lessons
+
+    @cached_property
+    def profile_parameters(self) -> tuple[str, ...]:
+        """
+            Поля профиля, по которым ветвится курс (ветвления типа profile_parameter)
+        """
+        parameters = set()
+
+        for block in self.root.m_blocks.values():
+            if isinstance(block, Branching) and block.type == BranchingType.profile_parameter.value:
+                parameters.add("gender" if block.content["parameter"] == 2 else "laboratory")
+
+        return tuple(sorted(parameters))
+
+    @cached_property
+    def has_profile_choices(self) -> bool:
+        """
+            Карта зависит от выборов профиля: есть ветвления с выбором или вложенные квесты
+        """
+        return any(
+            isinstance(block, Quest)
+            or isinstance(block, Branching) and block.type != BranchingType.profile_parameter.value
+            for block in self.m_blocks.values()
+        )
+
+    def get_summary(self, profile: Profile, progress: 'ProfileCourseProgress' = None) -> QuestSummary:
+        """
+            Размер и стоимость карты квеста для профиля.
+            Если карта зависит только от параметров профиля, итог запоминается в скомпилированном курсе
+        """
+        if self.root.version is None or self.has_profile_choices:
+            return self._build_summary(self.get_map_for_profile(profile, progress))
+
+        key = tuple(getattr(profile, parameter) for parameter in self.root.profile_parameters)
+        summary = self._summaries.get(key)
+
+        if summary is None:
+            summary = self._build_summary(self._resolve_map(profile, progress))
+            self._summaries[key] = summary
+
+        return summary
+
+    @staticmethod
+    def _build_summary(map_list: list[CourseBlockType]) -> QuestSummary:
+        return QuestSummary(
+            block_count=len(map_list),
+            money_cost=sum(block.money_cost for block in map_list if isinstance(block, Lesson)),
+        )
+
+    def get_map_fingerprint(self, profile: Profile, progress: 'ProfileCourseProgress' = None) -> str:
+        """
+            Отпечаток карты курса: у профилей с одинаковыми выборами ветвлений
+            и параметрами ветвления карта одна и та же
+        """
+        if progress is None:
+            progress = ProfileCourseProgress(profile)
+
+        fingerprint = (
+            self.root.version,
+            [getattr(profile, parameter) for parameter in self.root.profile_parameters],
+            sorted(progress.branching_choices.items()),
+        )
+        return hashlib.sha1(json.dumps(fingerprint, default=str).encode()).hexdigest()
+
+    @cached_property
+    def max_depth(self) -> int:
         stack = [self.tree.local_id]
         depth = 0
 
@@ -111,7 +333,7 @@ class CourseLessonsTree(AbstractNodeTree):
             node = self.tree_elements[stack[-1]]
 
             if isinstance(node.course_block, Quest):
-                quest_tree = CourseLessonsTree(node.course_block)
+                quest_tree = self.get_quest_tree(node.course_block)
                 quest_depth = quest_tree.get_max_depth()
                 depth += quest_depth
             elif isinstance(node.course_block, Lesson):
@@ -129,8 +351,46 @@ class CourseLessonsTree(AbstractNodeTree):
 
         return depth
 
-    @lru_cache
-    def get_map_for_profile(self, profile: Profile) -> list[Lesson | Branching | None]:
+    def _resolve_blocks(self, local_ids: list[str]) -> list[Lesson | Quest]:
+        m_blocks = self.root.m_blocks
+        blocks = [m_blocks[local_id] for local_id in local_ids if local_id in m_blocks]
+
+        # блоки вне скомпилированного курса ищем в БД, как и раньше
+        if len(blocks) != len(local_ids):
+            missed_local_ids = [local_id for local_id in local_ids if local_id not in m_blocks]
+            blocks.extend([
+                *Lesson.objects.filter(local_id__in=missed_local_ids),
+                *Quest.objects.filter(local_id__in=missed_local_ids),
+            ])
+            blocks.sort(key=lambda x: local_ids.index(x.local_id))
+
+        return [b for b in blocks if isinstance(b, (Lesson, Quest))]
+
+    def get_map_for_profile(
+        self,
+        profile: Profile,
+        progress: 'ProfileCourseProgress' = None,
+    ) -> list[Lesson | Branching | None]:
+        if progress is None:
+            progress = ProfileCourseProgress(profile)
+
+        # не скомпилированные деревья (без версии) не кэшируем
+        if self.root.version is None:
+            return self._resolve_map(profile, progress)
+
+        key = (
+            self.root.version, self.entity.__class__, self.entity.id,
+            profile.id, profile.gender, profile.laboratory, progress.version,
+        )
+        map_list = _profile_maps.get(key)
+
+        if map_list is None:
+            map_list = tuple(self._resolve_map(profile, progress))
+            _profile_maps.set(key, map_list)
+
+        return list(map_list)
+
+    def _resolve_map(self, profile: Profile, progress: 'ProfileCourseProgress') -> list[CourseBlockType]:
         stack: list[str] = [self.tree.local_id]
         map_list: list[CourseBlockType | None] = []
 
@@ -152,39 +412,29 @@ class CourseLessonsTree(AbstractNodeTree):
 
                 map_list.append(node.course_block)
 
-                choose_branch = (
-                    ProfileBranchingChoice.objects
-                    .filter(profile=profile, branching=node.course_block)
-                    .first()
-                )
+                choose_local_id = progress.branching_choices.get(node.course_block.id)
 
-                if not choose_branch or not choose_branch.choose_local_id:
+                if not choose_local_id:
                     break
 
-                choose_local_ids = choose_branch.choose_local_id.split(',')
+                choose_local_ids = choose_local_id.split(',')
 
                 if node.course_block.type == BranchingType.one_from_n.value:
                     stack.append(choose_local_ids[0])
                     continue
 
-                blocks = [
-                    *Lesson.objects.filter(local_id__in=choose_local_ids),
-                    *Quest.objects.filter(local_id__in=choose_local_ids)
-                ]
-                blocks.sort(key=lambda x: choose_local_ids.index(x.local_id))
-
-                for block in blocks:
+                for block in self._resolve_blocks(choose_local_ids):
                     if isinstance(block, Lesson):
                         map_list.append(block)
                         continue
 
-                    quest_tree = CourseLessonsTree(block)
-                    map_list.extend(quest_tree.get_map_for_profile(profile))
+                    quest_tree = self.get_quest_tree(block)
+                    map_list.extend(quest_tree.get_map_for_profile(profile, progress))
 
                 stack.append(node.course_block.content['next'])
             elif isinstance(node.course_block, Quest):
-                quest_tree = CourseLessonsTree(node.course_block)
-                map_list.extend(quest_tree.get_map_for_profile(profile))
+                quest_tree = self.get_quest_tree(node.course_block)
+                map_list.extend(quest_tree.get_map_for_profile(profile, progress))
 
                 if not node.course_block.next:
                     break
@@ -200,20 +450,247 @@ class CourseLessonsTree(AbstractNodeTree):
 
         return map_list
 
-    def get_active(self, profile: Profile) -> int:
-        map_list = self.get_map_for_profile(profile)
-        profile_interacted = {
-            *[p.lesson.local_id for p in ProfileLessonDone.objects.select_related("lesson").filter(profile=profile)],
-            *[b.branching.local_id for b in ProfileBranchingChoice.objects.select_related("branching").filter(profile=profile)]
-        }
-        course_map_images = CourseMapImg.objects.filter(course=Course.objects.first())
+    def get_next_block(
+        self,
+        profile: Profile,
+        local_id: str,
+        progress: 'ProfileCourseProgress' = None,
+    ) -> Lesson | Branching | None:
+        """
+            Блок карты профиля, следующий за local_id, по индексу позиций из снимка прогресса
+        """
+        snapshot = self.get_progress_snapshot(profile, progress)
+        position = snapshot.positions.get(local_id)
+
+        if position is None or position + 1 >= len(snapshot.map_list):
+            return None
+
+        return snapshot.map_list[position + 1]
+
+    def get_active(self, profile: Profile, progress: 'ProfileCourseProgress' = None) -> int:
+        return self.get_progress_snapshot(profile, progress).active
+
+    def get_progress_snapshot(
+        self,
+        profile: Profile,
+        progress: 'ProfileCourseProgress' = None,
+    ) -> CourseProgressSnapshot:
+        """
+            Карта, позиции блоков и активный блок профиля, посчитанные за один проход
+        """
+        if progress is None:
+            progress = ProfileCourseProgress(profile)
+
+        if self.version is None:
+            return self._build_progress_snapshot(profile, progress)
+
+        key = (
+            CourseProgressSnapshot, self.version, self.entity.id,
+            profile.id, profile.gender, profile.laboratory, progress.version,
+        )
+        snapshot = _profile_maps.get(key)
+
+        if snapshot is None:
+            snapshot = self._build_progress_snapshot(profile, progress)
+            _profile_maps.set(key, snapshot)
+
+        return snapshot
+
+    def _build_progress_snapshot(
+        self,
+        profile: Profile,
+        progress: 'ProfileCourseProgress',
+    ) -> CourseProgressSnapshot:
+        map_list = self.get_map_for_profile(profile, progress)
+        positions: dict[str, int] = {}
+        interacted: set[str] = set()
+        active_index = None
 
         for i, block in enumerate(map_list):
-            if block.local_id not in profile_interacted:
-                prev_images_count = course_map_images.filter(order__lte=i).count()
-                return i + course_map_images.filter(order__lte=i + prev_images_count).count()
-        map_len = len(map_list)
-        img_count = course_map_images.filter(
-            order__lte=map_len + course_map_images.filter(
-                order__lte=map_len).count()).count()
-        return map_len + img_count
+            positions.setdefault(block.local_id, i)
+
+            if progress.is_interacted(block):
+                interacted.add(block.local_id)
+            elif active_index is None:
+                active_index = i
+
+        if active_index is None:
+            active_index = len(map_list)
+
+        return CourseProgressSnapshot(
+            map_list=tuple(map_list),
+            positions=positions,
+            interacted=frozenset(interacted),
+            active=self._shift_by_map_images(active_index),
+        )
+
+    def _shift_by_map_images(self, index: int) -> int:
+        """
+            Переводит индекс в карте курса в индекс с учетом картинок между блоками
+        """
+        orders = self.root.map_image_orders
+        prev_images_count = bisect_right(orders, index)
+        return index + bisect_right(orders, index + prev_images_count)
+
+
+class ProfileCourseProgress:
+    """
+        Выборы ветвлений и пройденные уроки профиля.
+        Загружаются заранее (по одному запросу на каждую таблицу),
+        после чего карта курса строится по графу полностью в памяти
+    """
+
+    def __init__(self, profile: Profile) -> None:
+        self.profile = profile
+        # версию читаем до загрузки данных: запись между чтениями сменит ее
+        self.version = get_profile_progress_version(profile.id)
+
+    @cached_property
+    def branching_choices(self) -> dict[int, str]:
+        return dict(
+            ProfileBranchingChoice.objects
+            .filter(profile=self.profile)
+            .values_list("branching_id", "choose_local_id")
+        )
+
+    @cached_property
+    def done_lessons(self) -> LessonsBitset:
+        """
+            Пройденные уроки. Маска хранится в профиле и пишется только при прохождении урока
+            (см. mark_lesson_done), если она устарела - собирается из ProfileLessonDone без записи
+        """
+        course_tree = get_course_tree(self.profile.course_id)
+        ordinals = course_tree.lesson_ordinals
+
+        if self.profile.lessons_done_version == course_tree.lesson_ordinals_version:
+            return LessonsBitset.from_bytes(ordinals, bytes(self.profile.lessons_done_bits))
+
+        return _load_done_lessons(self.profile.id, ordinals)
+
+    def is_interacted(self, block: Lesson | Branching) -> bool:
+        if isinstance(block, Branching):
+            return block.id in self.branching_choices
+
+        return block.id in self.done_lessons
+
+
+_compiled_courses: dict[int, CourseLessonsTree] = {}
+_compiled_courses_lock = Lock()
+
+_profile_maps = LRUCache(
+    maxsize=settings.COURSE_MAP_CACHE_SIZE,
+    ttl=settings.COURSE_MAP_CACHE_TTL,
+)
+
+
+def _course_version_key(course_id: int) -> str:
+    return f"course_tree:{course_id}:version"
+
+
+def get_course_version(course_id: int) -> str:
+    return get_version(_course_version_key(course_id))
+
+
+def get_course_tree(course_id: int) -> CourseLessonsTree:
+    """
+        Возвращает скомпилированный граф курса.
+        Граф строится один раз на процесс и пересобирается только
+        после сохранения курса в редакторе (см. invalidate_course_tree)
+    """
+    version = get_course_version(course_id)
+    course_tree = _compiled_courses.get(course_id)
+
+    if course_tree is not None and course_tree.version == version:
+        return course_tree
+
+    course_tree = CourseLessonsTree(Course.objects.get(id=course_id))
+    course_tree.version = version
+
+    with _compiled_courses_lock:
+        _compiled_courses[course_id] = course_tree
+
+    return course_tree
+
+
+def get_quest_tree(quest: Quest) -> CourseLessonsTree:
+    if quest.course_id:
+        return get_course_tree(quest.course_id).get_quest_tree(quest)
+
+    return CourseLessonsTree(quest)
+
+
+def invalidate_course_tree(course_id: int | None) -> None:
+    if course_id is None:
+        return
+
+    bump_version(_course_version_key(course_id))
+
+
+def _load_done_lessons(profile_id: int, ordinals: dict[int, int]) -> LessonsBitset:
+    done_lessons = LessonsBitset(ordinals)
+
+    for lesson_id in ProfileLessonDone.objects.filter(profile_id=profile_id).values_list("lesson_id", flat=True):
+        done_lessons.add(lesson_id)
+
+    return done_lessons
+
+
+def mark_lesson_done(profile: Profile, lesson_id: int) -> bool:
+    """
+        Отмечает урок пройденным в маске профиля. Вызывается в одной транзакции
+        с созданием ProfileLessonDone: строка профиля блокируется, поэтому маска не расходится с таблицей.
+        Возвращает False, если урок уже пройден
+    """
+    course_tree = get_course_tree(profile.course_id)
+    ordinals = course_tree.lesson_ordinals
+    stored = (
+        Profile.objects
+        .select_for_update()
+        .filter(id=profile.id)
+        .values("lessons_done_bits", "lessons_done_version")
+        .get()
+    )
+
+    if lesson_id not in ordinals:
+        return not ProfileLessonDone.objects.filter(profile_id=profile.id, lesson_id=lesson_id).exists()
+
+    if stored["lessons_done_version"] == course_tree.lesson_ordinals_version:
+        done_lessons = LessonsBitset.from_bytes(ordinals, bytes(stored["lessons_done_bits"]))
+    else:
+        done_lessons = _load_done_lessons(profile.id, ordinals)
+
+    if lesson_id in done_lessons:
+        return False
+
+    done_lessons.add(lesson_id)
+    profile.lessons_done_bits = done_lessons.to_bytes()
+    profile.lessons_done_version = course_tree.lesson_ordinals_version
+
+    Profile.objects.filter(id=profile.id).update(
+        lessons_done_bits=profile.lessons_done_bits,
+        lessons_done_version=profile.lessons_done_version
+    )
+    return True
+
+
+def reset_done_lessons(profile_id: int) -> None:
+    """
+        Вызывается при удалении или изменении ProfileLessonDone не через прохождение урока:
+        маска профиля пересоберется из таблицы при следующем прохождении
+    """
+    Profile.objects.filter(id=profile_id).update(lessons_done_version="")
+
+
+def _profile_progress_version_key(profile_id: int) -> str:
+    return f"profile_progress:{profile_id}:version"
+
+
+def get_profile_progress_version(profile_id: int) -> str:
+    return get_version(_profile_progress_version_key(profile_id))
+
+
+def invalidate_profile_progress(profile_id: int) -> None:
+    """
+        Вызывается при записи выбора ветвления или прохождения урока
+    """
+    bump_version(_profile_progress_version_key(profile_id))
@@ -1,14 +1,41 @@
+import logging
+import random
+from abc import ABC, abstractmethod
 from collections import defaultdict, deque, namedtuple
-from functools import cached_property, lru_cache
+from copy import deepcopy
+from functools import cached_property
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.forms.models import model_to_dict
 
 from lessons.serializers import UnitDetailSerializer
-from lessons.models import Unit, Lesson
+from lessons.models import Unit, Lesson, LessonUnitsSnapshot
 from lessons.structures import LessonBlockType
+from lessons.structures.tasks import TaskBlock, TASK_MODELS
 from helpers.abstract_tree import AbstractNode, AbstractNodeTree
+from helpers.cache import get_version, bump_version, LRUCache
+
 
+logger = logging.getLogger(__name__)
 
 MockUnit = namedtuple("Unit", ("local_id", "type", "next", "content"))
 
+# Скомпилированный урок, который хранится в общем кэше:
+#   entry - первый юнит, units - юниты урока (связи в Unit.next),
+#   task_count - число заданий, lesson_key - ключ урока для finish,
+#   chunks - готовые чанки, units_data - сериализованные юниты и их задания
+CompiledLessonUnits = namedtuple(
+    "CompiledLessonUnits",
+    ("entry", "units", "task_count", "lesson_key", "chunks", "units_data")
+)
+
+# Готовый к отправке чанк урока. В queue задания уже без ответов,
+# tasks - пары (индекс в queue, задание) для перемешивания на каждый запрос,
+# для развилки (218) вместо задания - задания ее вариантов
+LessonChunk = namedtuple("LessonChunk", ("first_location_id", "first_npc_id", "queue", "tasks"))
+
 
 class LessonUnitsNode(AbstractNode):
     def __init__(self, unit: Unit | MockUnit, children: list['LessonUnitsNode'] = None):
@@ -38,7 +65,44 @@ class LessonUnitsNode(AbstractNode):
         return hash(self.local_id)
 
 
-class LessonUnitsTree(AbstractNodeTree):
+class LessonChunkContentMixin(ABC):
+    """
+        Восстановление content чанков игрока, сохраненных ссылкой на версию урока (см. get_chunk_storage)
+    """
+    units_data: dict[str, tuple[dict, TaskBlock | None]]
+
+    @abstractmethod
+    def get_pointed_content(self, unit_id: str) -> dict | None:
+        pass
+
+    @staticmethod
+    def _shuffle_task(unit_data: dict, task_instance: TaskBlock, seed: int = None) -> dict:
+        content = deepcopy(unit_data['content'])
+
+        # с тем же seed порядок вариантов повторяется, поэтому его достаточно сохранить в чанке игрока
+        rng = random.Random(f"{seed}:{unit_data['id']}") if seed is not None else None
+        task_instance.shuffle_content(content, rng)
+
+        return {**unit_data, 'content': content}
+
+    def get_chunk_content(self, unit_id: str, delta: dict) -> dict | None:
+        if delta.get("pointed"):
+            content = self.get_pointed_content(unit_id)
+        elif unit_id in self.units_data:
+            content, task_instance = self.units_data[unit_id]
+
+            if task_instance is not None:
+                content = self._shuffle_task(content, task_instance, delta.get("seed"))
+        else:
+            content = None
+
+        if content is not None and "answer" in delta:
+            content = {**content, "answer": delta["answer"]}
+
+        return content
+
+
+class LessonUnitsTree(LessonChunkContentMixin, AbstractNodeTree):
     """
         Класс, предоставляющий список юнитов конкретного урока
         в отсортированном и необходимом виде
@@ -46,9 +110,19 @@ class LessonUnitsTree(AbstractNodeTree):
     node_cls = LessonUnitsNode
     tree_elements: dict[str, LessonUnitsNode]
 
-    def __init__(self, lesson: Lesson) -> None:
+    def __init__(self, lesson: Lesson, compiled: CompiledLessonUnits = None) -> None:
         self.lesson: Lesson = lesson
-        self.units = list(lesson.unit_set.all())
+        self.compiled = compiled
+        self.version = None
+        self._snapshot_saved = False
+
+        if compiled is None:
+            self.entry = lesson.content.entry
+            self.units = list(lesson.unit_set.all())
+        else:
+            self.entry = compiled.entry
+            self.units = list(compiled.units)
+
         self.m_units = {unit.local_id: unit for unit in self.units}
 
         self.block_units_type = [
@@ -70,8 +144,21 @@ class LessonUnitsTree(AbstractNodeTree):
         self._add_end_unit()
 
     def get_hash(self):
+        if self.compiled is not None:
+            return self.compiled.lesson_key
+
         return str(hash(str(len(self.units))))
 
+    def compile(self) -> CompiledLessonUnits:
+        return CompiledLessonUnits(
+            entry=self.entry,
+            units=tuple(self.units),
+            task_count=self.task_count,
+            lesson_key=self.get_hash(),
+            chunks=self.chunks,
+            units_data=self.units_data,
+        )
+
     def _add_end_unit(self):
         queue = [self.tree.id]
         visited = defaultdict(bool)
@@ -95,8 +182,8 @@ class LessonUnitsTree(AbstractNodeTree):
             i += 1
 
     def _get_first_element(self):
-        if self.lesson.content.entry:
-            return self._get_element_by_id(self.lesson.content.entry)
+        if self.entry:
+            return self._get_element_by_id(self.entry)
 
         return namedtuple('Unit', ('local_id', 'type', 'next'))(-1, 0, [])
 
@@ -106,26 +193,161 @@ class LessonUnitsTree(AbstractNodeTree):
     def _generate_a18(self, units: list[Unit]) -> dict:
         return {
             'type': 218,
-            'content': {'variants': UnitDetailSerializer(units, many=True).data},
+            'content': {'variants': UnitDetailSerializer(units, many=True, context={"shuffle_tasks": False}).data},
             'has_callback': all([u.profile_affect_id for u in units])
         }
 
-    @lru_cache(maxsize=1)
-    def make_lessons_queue(self, from_unit_id: str = None, hide_task_answers: bool = False) -> tuple[int, int, list[dict]]:
-        if not self.lesson.content.entry:
-            return -1, -1, UnitDetailSerializer([self.tree_elements["end_unit"].unit], many=True).data
+    def make_lessons_queue(
+        self,
+        from_unit_id: str = None,
+        seed: int = None,
+    ) -> tuple[int, int, list[dict]]:
+        chunk = self.chunks[from_unit_id or None] if self.entry else self.chunks[None]
+        queue = list(chunk.queue)
+
+        for index, task in chunk.tasks:
+            if isinstance(task, tuple):
+                queue[index] = self._shuffle_a18(queue[index], task, seed)
+            else:
+                queue[index] = self._shuffle_task(queue[index], task, seed)
+
+        return chunk.first_location_id, chunk.first_npc_id, queue
+
+    @classmethod
+    def _shuffle_a18(cls, unit_data: dict, variant_tasks: tuple[TaskBlock | None, ...], seed: int = None) -> dict:
+        variants = [
+            cls._shuffle_task(variant, task_instance, seed) if task_instance is not None else variant
+            for variant, task_instance in zip(unit_data['content']['variants'], variant_tasks)
+        ]
+
+        return {**unit_data, 'content': {**unit_data['content'], 'variants': variants}}
+
+    def get_chunk_storage(self, unit_data: dict, seed: int = None) -> dict:
+        """
+            Поля ProfileLessonChunk для юнита из make_lessons_queue:
+            ссылка на версию урока или полная копия, если юнита нет в скомпилированном уроке
+        """
+        if self.version is None or unit_data.get('id') not in self.units_data:
+            return {"content": unit_data}
+
+        _, task_instance = self.units_data[unit_data['id']]
+        delta = {"seed": seed} if task_instance is not None and seed is not None else {}
+
+        self.save_snapshot()
+        return {"content_version": self.version, "delta": delta}
+
+    def get_pointed_chunk_storage(self, unit: Unit) -> dict:
+        if self.version is None or unit.local_id not in self.m_units:
+            return {"content": model_to_dict(unit)}
+
+        self.save_snapshot()
+        return {"content_version": self.version, "delta": {"pointed": True}}
+
+    def to_snapshot(self) -> dict:
+        """
+            Данные версии урока для LessonUnitsSnapshot: все, что нужно get_chunk_content, в виде JSON
+        """
+        return {
+            "units": {unit.local_id: model_to_dict(unit) for unit in self.units},
+            "units_data": {
+                unit_id: [unit_data, model_to_dict(task_instance) if task_instance is not None else None]
+                for unit_id, (unit_data, task_instance) in self.units_data.items()
+            },
+        }
+
+    def save_snapshot(self) -> None:
+        """
+            Сохраняет версию урока в БД до того, как на нее сошлется чанк игрока.
+            Вставка выполняется один раз на версию в процессе, повторные игнорируются
+        """
+        if self.version is None or self._snapshot_saved:
+            return
+
+        LessonUnitsSnapshot.objects.bulk_create([
+            LessonUnitsSnapshot(lesson_id=self.lesson.id, version=self.version, units=self.to_snapshot())
+        ], ignore_conflicts=True)
+
+        # при откате транзакции снимок будет сохранен со следующим чанком
+        transaction.on_commit(lambda: setattr(self, "_snapshot_saved", True))
+
+    def get_task(self, unit_id: str) -> TaskBlock | None:
+        """
+            Задание юнита из скомпилированного урока, без запросов к БД
+        """
+        unit_data = self.units_data.get(unit_id)
 
+        if unit_data is None:
+            return None
+
+        return unit_data[1]
+
+    def get_pointed_content(self, unit_id: str) -> dict | None:
+        unit = self.m_units.get(unit_id)
+        return model_to_dict(unit) if unit is not None else None
+
+    @cached_property
+    def chunks(self) -> dict[str | None, LessonChunk]:
+        if self.compiled is not None:
+            return self.compiled.chunks
+
+        return self._build_chunks()
+
+    @cached_property
+    def task_instances(self) -> dict[tuple[int, str], TaskBlock]:
+        return UnitDetailSerializer.load_task_instances(self.units)
+
+    @cached_property
+    def units_data(self) -> dict[str, tuple[dict, TaskBlock | None]]:
+        """
+            Юниты урока, сериализованные один раз (задания - без ответов и перемешивания)
+        """
+        if self.compiled is not None:
+            return self.compiled.units_data
+
+        if not self.entry:
+            return {}
+
+        return {node.local_id: self._serialize_unit(node) for node in self.tree_elements.values()}
+
+    def _build_chunks(self) -> dict[str | None, LessonChunk]:
+        """
+            Чанки урока для каждой точки входа (None - начало урока)
+        """
+        if not self.entry:
+            end_unit_data = UnitDetailSerializer([self.tree_elements["end_unit"].unit], many=True).data
+            return {None: LessonChunk(-1, -1, tuple(end_unit_data), ())}
+
+        chunks = {None: self._build_chunk(None)}
+
+        for unit_id in self.tree_elements:
+            chunks[unit_id] = self._build_chunk(unit_id)
+
+        return chunks
+
+    def _serialize_unit(self, node: LessonUnitsNode) -> tuple[dict, TaskBlock | None]:
+        task_instance = None
+
+        if node.type != LessonBlockType.replica.value:
+            unit_data = dict(UnitDetailSerializer(node.unit, context={"shuffle_tasks": False}).data)
+
+            if 300 <= node.type < 400:
+                task_instance = UnitDetailSerializer.get_task_instance(node.unit, self.task_instances)
+        else:
+            unit_data = self._generate_a18([node.unit])
+
+        return unit_data, task_instance
+
+    def _build_chunk(self, from_unit_id: str | None) -> LessonChunk:
         first_location_id = first_npc_id = None
-        node = self.tree_elements[from_unit_id or self.lesson.content.entry]
+        node = self.tree_elements[from_unit_id or self.entry]
         queue = []
+        tasks = []
 
         while not queue or node:
-            if node.type != LessonBlockType.replica.value:
-                unit_data = UnitDetailSerializer(node.unit).data
-            else:
-                unit_data = self._generate_a18([node.unit])
+            unit_data, task_instance = self.units_data[node.local_id]
 
             queue.append(unit_data)
+            tasks.append(task_instance)
 
             if len(queue) > 1 and node.type in self.block_units_type:
                 break
@@ -134,8 +356,11 @@ class LessonUnitsTree(AbstractNodeTree):
             first_npc_id = first_npc_id or queue[-1].get('content', {}).get('npc')
 
             if len(node.children) >= 2:
-                replica_units = [child.obj for child in node.children]
-                queue.append(self._generate_a18(replica_units))
+                children = list(node.children)
+                variant_tasks = tuple(self.units_data[child.local_id][1] for child in children)
+
+                queue.append(self._generate_a18([child.obj for child in children]))
+                tasks.append(variant_tasks if any(variant_tasks) else None)
                 break
 
             node = list(node.children)[0] if node.children else None
@@ -143,12 +368,21 @@ class LessonUnitsTree(AbstractNodeTree):
         if from_unit_id:
             # except pointed
             queue = queue[1:]
+            tasks = tasks[1:]
 
-        return first_location_id, first_npc_id, queue
+        return LessonChunk(
+            first_location_id=first_location_id,
+            first_npc_id=first_npc_id,
+            queue=tuple(queue),
+            tasks=tuple((index, task) for index, task in enumerate(tasks) if task is not None),
+        )
 
     @cached_property
     def task_count(self):
-        if not self.lesson.content.entry:
+        if self.compiled is not None:
+            return self.compiled.task_count
+
+        if not self.entry:
             return 0
 
         stack = deque([self.tree])
@@ -174,3 +408,153 @@ class LessonUnitsTree(AbstractNodeTree):
                 current_task_count -= stack.pop().is_task
 
         return max_task_count
+
+
+class LessonUnitsSnapshotTree(LessonChunkContentMixin):
+    """
+        Прошлая версия урока, восстановленная из LessonUnitsSnapshot.
+        Нужна только для восстановления чанков игроков, сохраненных ссылкой на эту версию
+    """
+
+    def __init__(self, lesson: Lesson, snapshot: LessonUnitsSnapshot) -> None:
+        self.lesson = lesson
+        self.version = snapshot.version
+        self.pointed_units: dict[str, dict] = snapshot.units["units"]
+        self.units_data = {
+            unit_id: (unit_data, self._restore_task(unit_data, task_fields))
+            for unit_id, (unit_data, task_fields) in snapshot.units["units_data"].items()
+        }
+
+    @staticmethod
+    def _restore_task(unit_data: dict, task_fields: dict | None) -> TaskBlock | None:
+        if task_fields is None:
+            return None
+
+        return TASK_MODELS[unit_data["type"]](**task_fields)
+
+    def get_pointed_content(self, unit_id: str) -> dict | None:
+        return self.pointed_units.get(unit_id)
+
+
+_compiled_lessons = LRUCache(maxsize=settings.LESSON_UNITS_CACHE_SIZE)
+
+
+def _lesson_units_version_key(lesson_id: int) -> str:
+    return f"lesson_units:{lesson_id}:version"
+
+
+def get_lesson_units_version(lesson_id: int) -> str:
+    return get_version(_lesson_units_version_key(lesson_id))
+
+
+def get_lesson_units_tree(lesson: Lesson, version: str = None) -> LessonUnitsTree | LessonUnitsSnapshotTree:
+    """
+        Возвращает скомпилированный граф юнитов урока.
+        Граф хранится в памяти процесса, а его данные - в общем кэше,
+        поэтому юниты читаются из БД один раз на версию урока
+        (см. invalidate_lesson_units).
+        Прошлая версия урока отдается из общего кэша, а после его истечения - из снимка в БД
+    """
+    current_version = get_lesson_units_version(lesson.id)
+    version = version or current_version
+    lesson_tree = _compiled_lessons.get((lesson.id, version))
+
+    if lesson_tree is not None:
+        return lesson_tree
+
+    cache_key = f"lesson_units:{lesson.id}:{version}"
+    compiled = cache.get(cache_key)
+
+    if compiled is None:
+        if version != current_version:
+            return get_lesson_units_snapshot(lesson, version)
+
+        compiled = LessonUnitsTree(lesson).compile()
+        cache.set(cache_key, compiled, timeout=settings.LESSON_UNITS_CACHE_TTL)
+
+    lesson_tree = LessonUnitsTree(lesson, compiled)
+    lesson_tree.version = version
+
+    _compiled_lessons.set((lesson.id, version), lesson_tree)
+
+    return lesson_tree
+
+
+def get_lesson_units_snapshot(lesson: Lesson, version: str) -> LessonUnitsTree | LessonUnitsSnapshotTree:
+    snapshot = LessonUnitsSnapshot.objects.filter(lesson=lesson, version=version).first()
+
+    if snapshot is None:
+        # чанки, сохраненные до появления снимков: другой версии урока для них нет
+        logger.warning(f"Lesson {lesson.id} has no snapshot of version {version}, current version is used")
+        return get_lesson_units_tree(lesson)
+
+    lesson_tree = LessonUnitsSnapshotTree(lesson, snapshot)
+    _compiled_lessons.set((lesson.id, version), lesson_tree)
+
+    return lesson_tree
+
+
+def update_lesson_aggregates(lesson: Lesson, units: tuple[Unit, ...]) -> None:
+    """
+        Сохраняет в урок сводку по его юнитам, чтобы не считать ее по таблице юнитов во время игры
+    """
+    lesson.unit_count = len(units)
+    lesson.next_days_count = sum(
+        unit.content.get("value", 0) for unit in units
+        if unit.type == LessonBlockType.a17_days.value
+    )
+
+    Lesson.objects.filter(id=lesson.id).update(
+        unit_count=lesson.unit_count,
+        next_days_count=lesson.next_days_count
+    )
+
+
+def invalidate_lesson_units(lesson_id: int | None) -> None:
+    if lesson_id is None:
+        return
+
+    bump_version(_lesson_units_version_key(lesson_id))
+
+
+def rebuild_lesson_units(lesson_id: int | None) -> None:
+    """
+        Инвалидирует урок и сразу собирает его чанки после сохранения в редакторе,
+        чтобы игрокам не приходилось ждать сборки. Там же обновляется сводка по юнитам урока
+    """
+    if lesson_id is None:
+        return
+
+    def compile_lesson() -> None:
+        invalidate_lesson_units(lesson_id)
+        lesson = Lesson.objects.select_related("content").filter(id=lesson_id).first()
+
+        if lesson is not None:
+            update_lesson_aggregates(lesson, tuple(get_lesson_units_tree(lesson).units))
+
+    transaction.on_commit(compile_lesson)
+
+
+def rehydrate_chunks(lesson: Lesson | None, chunks: list[dict]) -> list[dict]:
+    """
+        Восстанавливает content чанков игрока (ProfileLessonChunk.values()),
+        сохраненных ссылкой на версию урока
+    """
+    lesson_trees: dict[str, LessonUnitsTree] = {}
+    rehydrated_chunks = []
+
+    for chunk in chunks:
+        chunk = dict(chunk)
+        content_version = chunk.pop("content_version", "")
+        delta = chunk.pop("delta", None) or {}
+
+        if content_version and lesson is not None:
+            if content_version not in lesson_trees:
+                lesson_trees[content_version] = get_lesson_units_tree(lesson, content_version)
+
+            content = lesson_trees[content_version].get_chunk_content(chunk["unit_id"], delta)
+            chunk["content"] = content if content is not None else {}
+
+        rehydrated_chunks.append(chunk)
+
+    return rehydrated_chunks
@@ -0,0 +1,27 @@
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class OnCommitCallbacksMixin:
+    """
+        TestCase.captureOnCommitCallbacks из Django 3.2.
+        TestCase выполняет каждый тест в транзакции, которая не коммитится,
+        поэтому колбэки transaction.on_commit в нем не вызываются
+    """
+
+    @classmethod
+    @contextmanager
+    def captureOnCommitCallbacks(cls, *, using: str = DEFAULT_DB_ALIAS, execute: bool = False):
+        callbacks = []
+        start_count = len(connections[using].run_on_commit)
+
+        try:
+            yield callbacks
+        finally:
+            run_on_commit = connections[using].run_on_commit[start_count:]
+            callbacks[:] = [func for sids, func in run_on_commit]
+
+            if execute:
+                for callback in callbacks:
+                    callback()
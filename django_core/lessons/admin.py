@@ -1,6 +1,7 @@
 from django.contrib import admin
 
 from lessons import models
+from helpers.course_tree import reset_done_lessons
 
 
 @admin.register(models.Lesson)
@@ -102,6 +103,12 @@ class ProfileLessonsDoneAdmin(admin.ModelAdmin):
         "lesson__local_id"
     )
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # маска пройденных уроков в профиле пишется только при прохождении урока
+        for profile_id in {obj.profile_id, form.initial.get("profile")} - {None}:
+            reset_done_lessons(profile_id)
+
 
 @admin.register(models.ProfileCourseDone)
 class ProfileCourseDoneAdmin(admin.ModelAdmin):
@@ -0,0 +1,38 @@
+# Generated by Django 3.1.7 on 2026-10-17 14:58
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def remove_duplicate_chunks(apps, schema_editor):
+    ProfileLessonChunk = apps.get_model('lessons', 'ProfileLessonChunk')
+
+    duplicates = (
+        ProfileLessonChunk.objects
+        .values('lesson_id', 'unit_id')
+        .annotate(first_id=Min('id'), chunks_count=Count('id'))
+        .filter(chunks_count__gt=1)
+    )
+
+    for duplicate in duplicates:
+        (
+            ProfileLessonChunk.objects
+            .filter(lesson_id=duplicate['lesson_id'], unit_id=duplicate['unit_id'])
+            .exclude(id=duplicate['first_id'])
+            .delete()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0034_profilelesson_profilelessonchunk'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_chunks, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='profilelessonchunk',
+            unique_together={('lesson', 'unit_id')},
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.7 on 2026-10-17 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0035_profilelessonchunk_unique_unit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profilelessonchunk',
+            name='content_version',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='profilelessonchunk',
+            name='delta',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.1.7 on 2026-10-17 15:11
+
+from django.db import migrations, models
+
+
+def fill_lesson_aggregates(apps, schema_editor):
+    Lesson = apps.get_model('lessons', 'Lesson')
+    Unit = apps.get_model('lessons', 'Unit')
+
+    lessons = {lesson.id: lesson for lesson in Lesson.objects.only('id')}
+
+    for lesson_id, unit_type, content in Unit.objects.filter(lesson__isnull=False).values_list('lesson_id', 'type', 'content'):
+        lesson = lessons[lesson_id]
+        lesson.unit_count += 1
+
+        if unit_type == 217:
+            lesson.next_days_count += content.get('value', 0)
+
+    Lesson.objects.bulk_update(lessons.values(), ['unit_count', 'next_days_count'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0036_profilelessonchunk_delta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lesson',
+            name='next_days_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='lesson',
+            name='unit_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_lesson_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.1.7 on 2026-10-17 15:13
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def remove_duplicate_choices(apps, schema_editor):
+    ProfileBranchingChoice = apps.get_model('lessons', 'ProfileBranchingChoice')
+
+    duplicates = (
+        ProfileBranchingChoice.objects
+        .values('profile_id', 'branching_id')
+        .annotate(first_id=Min('id'), choices_count=Count('id'))
+        .filter(choices_count__gt=1)
+    )
+
+    for duplicate in duplicates:
+        (
+            ProfileBranchingChoice.objects
+            .filter(profile_id=duplicate['profile_id'], branching_id=duplicate['branching_id'])
+            .exclude(id=duplicate['first_id'])
+            .delete()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0036_profile_lessons_done_bits'),
+        ('lessons', '0037_lesson_unit_aggregates'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_choices, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='profilebranchingchoice',
+            unique_together={('profile', 'branching')},
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.1.7 on 2026-10-17 15:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0038_profilebranchingchoice_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LessonUnitsSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.CharField(max_length=32)),
+                ('units', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('lesson', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='units_snapshots', to='lessons.lesson')),
+            ],
+            options={
+                'unique_together': {('lesson', 'version')},
+            },
+        ),
+    ]
@@ -108,6 +108,9 @@ class ProfileBranchingChoice(models.Model):
     branching = models.ForeignKey("Branching", on_delete=models.CASCADE)
     choose_local_id = models.CharField(max_length=120, blank=True)
 
+    class Meta:
+        unique_together = ("profile", "branching")
+
     def __str__(self):
         return f"ProfileBranchingChoice[{self.id}] {self.profile} on {self.branching.local_id}"
 
@@ -153,6 +156,10 @@ class Lesson(EditorBlockModel):
 
     profile_affect = models.ForeignKey("UnitAffect", null=True, on_delete=models.SET_NULL, blank=True)
 
+    # сводка по юнитам, обновляется при сборке урока (см. helpers.lesson_tree.get_lesson_units_tree)
+    unit_count = models.PositiveIntegerField(default=0, editable=False)
+    next_days_count = models.IntegerField(default=0, editable=False)
+
     def __str__(self):
         return f"Lesson[{self.id}] {self.course}"
 
@@ -330,9 +337,31 @@ class ProfileLessonChunk(models.Model):
     type = models.IntegerField(default=0)
     content = models.JSONField(default={})
     unit_id = models.CharField(max_length=64, default="", blank=True)
+    # если задана версия урока, content не хранится и восстанавливается из скомпилированного урока,
+    # а в delta лежат только данные игрока (seed перемешивания, ответ)
+    content_version = models.CharField(max_length=32, default="", blank=True)
+    delta = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        unique_together = ("lesson", "unit_id")
 
     def __repr__(self) -> str:
         return f"[{self.lesson.lesson_name}] {self.lesson.player}"
 
     def __str__(self) -> str:
         return repr(self)
+
+
+class LessonUnitsSnapshot(models.Model):
+    """
+        Версия урока, на которую ссылаются чанки игроков (ProfileLessonChunk.content_version).
+        Хранит сериализованные юниты и их задания, чтобы историю урока можно было восстановить
+        после его изменения, когда скомпилированной версии уже нет в общем кэше
+    """
+    lesson = models.ForeignKey(Lesson, on_delete=models.CASCADE, related_name="units_snapshots")
+    version = models.CharField(max_length=32)
+    units = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("lesson", "version")
@@ -1,11 +1,14 @@
 import datetime as dt
-from functools import lru_cache
+from collections import defaultdict
+from copy import deepcopy
+from typing import Iterable
 
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from django.conf import settings
+from django.core.cache import cache
 from django.db.models import Sum
-from django.db import transaction
+from django.db import models, transaction, IntegrityError
 
 from accounts.models import Profile
 from lessons.models import (
@@ -23,7 +26,6 @@ from lessons.models import (
     UnitAffect,
     EmailTypes,
     ProfileCourseDone,
-    ProfileLessonDone,
     ProfileLesson,
     ProfileLessonChunk
 )
@@ -32,17 +34,18 @@ from lessons.structures import (
     BranchingType,
     BranchingViewType
 )
-from lessons.structures.tasks import TaskBlock
+from lessons.structures.tasks import TaskBlock, TASK_MODELS
 from lessons.utils import process_affect
 from lessons.exceptions import (
     BranchingAlreadyChosenException,
     BlockNotFoundException,
     NotEnoughBlocksToSelectBranchException
 )
-from helpers.course_tree import CourseLessonsTree
+from helpers.course_tree import get_course_tree, get_quest_tree, CourseLessonsTree, ProfileCourseProgress
 from resources.exceptions import NotEnoughMoneyException
 from resources.serializers import EmotionDataSerializer
-from resources.utils import get_salary_by_position
+from resources.models import ResourcesEventReason
+from resources.utils import get_salary_by_position, change_resources
 
 User = get_user_model()
 
@@ -69,6 +72,18 @@ class UnitAffectSerializer(serializers.ModelSerializer):
         fields = ["code", "api_path", "method", "body"]
 
 
+class UnitDetailListSerializer(serializers.ListSerializer):
+    def to_representation(self, data) -> list[dict]:
+        units = list(data.all() if isinstance(data, models.Manager) else data)
+
+        # задания всех юнитов загружаются заранее, по одному запросу на тип
+        if self.context.get("shuffle_tasks", True):
+            task_instances = self.context.setdefault("task_instances", {})
+            task_instances.update(UnitDetailSerializer.load_task_instances(units))
+
+        return super().to_representation(units)
+
+
 class UnitDetailSerializer(serializers.ModelSerializer):
     id = serializers.CharField(source="local_id")
     content = serializers.SerializerMethodField()
@@ -77,21 +92,55 @@ class UnitDetailSerializer(serializers.ModelSerializer):
         if not (300 <= unit.type < 400):
             return unit.content
 
-        task_models = {t_model.type.value: t_model for t_model in TaskBlock.get_all_subclasses()}
-        task_model = task_models[unit.type]
+        # юниты урока переиспользуются между запросами (см. get_lesson_units_tree)
+        content = self.hide_answer(unit.type, unit.content)
+
+        # при подготовке чанков урока варианты перемешиваются позже, на каждый запрос
+        if self.context.get("shuffle_tasks", True):
+            task_instance = self.get_task_instance(unit, self.context.get("task_instances"))
+            task_instance.shuffle_content(content)
+
+        return content
+
+    @staticmethod
+    def load_task_instances(units: Iterable[Unit]) -> dict[tuple[int, str], TaskBlock]:
+        task_ids = defaultdict(set)
+
+        for unit in units:
+            if 300 <= unit.type < 400:
+                task_ids[unit.type].add(unit.content["id"])
+
+        return {
+            (unit_type, str(task_instance.id)): task_instance
+            for unit_type, ids in task_ids.items()
+            for task_instance in TASK_MODELS[unit_type].objects.filter(id__in=ids)
+        }
+
+    @classmethod
+    def get_task_instance(
+        cls,
+        unit: Unit,
+        task_instances: dict[tuple[int, str], TaskBlock] = None,
+    ) -> TaskBlock | None:
+        if task_instances is None or (unit.type, str(unit.content["id"])) not in task_instances:
+            task_instances = cls.load_task_instances([unit])
+
+        return task_instances.get((unit.type, str(unit.content["id"])))
 
-        task_instance: TaskBlock = task_model.objects.filter(id=unit.content["id"]).only().first()
-        task_instance.shuffle_content(unit.content)
+    @staticmethod
+    def hide_answer(unit_type: int, content: dict) -> dict:
+        content = deepcopy(content)
 
         # возвращаем correct только для T2
-        if "correct" in unit.content and unit.type != 302:
-            unit.content.pop("correct")
+        if "correct" in content and unit_type != 302:
+            content.pop("correct")
 
-        return unit.content
+        return content
 
     class Meta:
         model = Unit
         fields = ["id", "type", "content"]
+        list_serializer_class = UnitDetailListSerializer
 
 
 class LessonDetailSerializer(serializers.ModelSerializer):
@@ -105,7 +154,7 @@ class LessonDetailSerializer(serializers.ModelSerializer):
         if self.context.get("finished", False):
             return {"energy": 0, "money": 0}
 
-        profile = self.context["request"].user.profile.get()
+        profile = self.context["request"].profile
 
         if not profile.scientific_director_id:
             return {"energy": 0, "money": 0}
@@ -134,16 +183,17 @@ class QuestChoiceSerializer(serializers.ModelSerializer):
     lessons = serializers.SerializerMethodField()
     money_cost = serializers.SerializerMethodField()
 
+    def _get_quest_lessons(self, quest: Quest) -> list[Lesson]:
+        quest_tree = get_quest_tree(quest)
+        profile = self.context['request'].profile
+        return quest_tree.get_map_for_profile(profile, self.context.get("progress"))
+
     def get_money_cost(self, quest: Quest) -> int:
-        quest_tree = CourseLessonsTree(quest)
-        profile = self.context['request'].user.profile.get(course_id=1)
-        map_list = quest_tree.get_map_for_profile(profile)
-        return sum([l.money_cost for l in map_list if isinstance(l, Lesson)])
+        profile = self.context['request'].profile
+        return get_quest_tree(quest).get_summary(profile, self.context.get("progress")).money_cost
 
     def get_lessons(self, obj: Quest) -> dict:
-        quest_tree = CourseLessonsTree(obj)
-        profile = self.context['request'].user.profile.get(course_id=1)
-        lessons = quest_tree.get_map_for_profile(profile)
+        lessons = self._get_quest_lessons(obj)
         return LessonChoiceSerializer(lessons, many=True).data
 
     class Meta:
@@ -225,40 +275,78 @@ class BranchingDetailSerializer(serializers.ModelSerializer):
     def get_locale(self, obj: Branching) -> dict:
         return obj.course.locale
 
-    def get_type(self, obj: Branching):
-        if obj.type == BranchingType.profile_parameter.value:
-            return BranchingViewType.parameter.value
-        elif obj.type == BranchingType.six_from_n.value:
-            return BranchingViewType.m_from_n.value
+    def _get_choices_payload(self, obj: Branching) -> dict:
+        """
+            Не зависящая от профиля часть ветвления: тип отображения, уроки-варианты и local_id квестов.
+            Собирается по скомпилированному курсу и хранится в общем кэше до смены версии курса
+        """
+        if "branching_choices_payload" not in self.context:
+            self.context["branching_choices_payload"] = {}
 
-        quests = Quest.objects.filter(local_id__in=obj.content["next"])
+        # тип и варианты ветвления читаются одним обращением к кэшу на ветвление
+        payloads = self.context["branching_choices_payload"]
 
-        if quests.count() == len(obj.content["next"]):
-            return BranchingViewType.fork.value
+        if obj.id not in payloads:
+            payloads[obj.id] = self._load_choices_payload(obj)
 
-        return BranchingViewType.lessons_fork.value
+        return payloads[obj.id]
 
-    def get_choices(self, obj: Branching) -> None:
-        lesson_local_ids = []
+    def _load_choices_payload(self, obj: Branching) -> dict:
+        course_tree = get_course_tree(obj.course_id)
+        cache_key = f"branching_choices:{obj.id}:{course_tree.version}"
+        payload = cache.get(cache_key)
+
+        if payload is not None:
+            return payload
+
+        local_ids = []
 
         if obj.type == BranchingType.six_from_n.value:
-            lesson_local_ids.extend(obj.content['list'])
+            local_ids.extend(obj.content['list'])
 
         if obj.type == BranchingType.one_from_n.value:
-            lesson_local_ids.extend(obj.content['next'])
+            local_ids.extend(obj.content['next'])
+
+        blocks = [course_tree.m_blocks[local_id] for local_id in local_ids if local_id in course_tree.m_blocks]
+        lessons = sorted((b for b in blocks if isinstance(b, Lesson)), key=lambda lesson: lesson.id)
+        quests = sorted((b for b in blocks if isinstance(b, Quest)), key=lambda quest: quest.id)
+
+        if obj.type == BranchingType.profile_parameter.value:
+            view_type = BranchingViewType.parameter.value
+        elif obj.type == BranchingType.six_from_n.value:
+            view_type = BranchingViewType.m_from_n.value
+        elif all(isinstance(course_tree.m_blocks.get(local_id), Quest) for local_id in obj.content["next"]):
+            view_type = BranchingViewType.fork.value
+        else:
+            view_type = BranchingViewType.lessons_fork.value
+
+        payload = {
+            "type": view_type,
+            "lessons": [dict(lesson_data) for lesson_data in LessonChoiceSerializer(lessons, many=True).data],
+            "quest_ids": [quest.local_id for quest in quests],
+        }
+        cache.set(cache_key, payload, timeout=settings.COURSE_MAP_CACHE_TTL)
+
+        return payload
+
+    def get_type(self, obj: Branching):
+        return self._get_choices_payload(obj)["type"]
+
+    def get_choices(self, obj: Branching) -> None:
+        payload = self._get_choices_payload(obj)
+        course_tree = get_course_tree(obj.course_id)
+
+        # варианты-квесты зависят от карты профиля внутри квеста
+        if "progress" not in self.context:
+            self.context["progress"] = ProfileCourseProgress(self.context['request'].profile)
 
-        lessons_data = LessonChoiceSerializer(
-            Lesson.objects.filter(local_id__in=lesson_local_ids), many=True
-        ).data
         quests_data = QuestChoiceSerializer(
-            Quest.objects
-            .filter(local_id__in=lesson_local_ids)
-            .prefetch_related("lessons"),
+            [course_tree.m_blocks[local_id] for local_id in payload["quest_ids"]],
             many=True,
             context=self.context
         ).data
 
-        return lessons_data + quests_data
+        return payload["lessons"] + quests_data
 
     class Meta:
         model = Branching
@@ -272,19 +360,17 @@ class BranchingSelectSerializer(serializers.ModelSerializer):
         model = Branching
         fields = ["choose_local_id"]
 
-    @lru_cache
     def _get_blocks(self, local_ids: str) -> list[Lesson | Quest]:
-        blocks = [
-            *(
-                Lesson.objects.filter(quest__isnull=True, local_id__in=local_ids.split(","))
-                .select_related("profile_affect")
-            ),
-            *(
-                Quest.objects.filter(local_id__in=local_ids.split(","))
-                .prefetch_related("lessons", "branchings")
-            ),
+        """
+            Уроки вне квестов и квесты курса по local_id из скомпилированного курса
+        """
+        m_blocks = get_course_tree(self.instance.course_id).m_blocks
+        blocks = [m_blocks.get(local_id) for local_id in dict.fromkeys(local_ids.split(","))]
+
+        return [
+            block for block in blocks
+            if isinstance(block, Quest) or isinstance(block, Lesson) and block.quest_id is None
         ]
-        return blocks
 
     def validate_choose_local_id(self, choose_local_id: str) -> str:
         local_ids = ",".join(list(map(lambda x: x.strip(), choose_local_id.split(","))))
@@ -299,7 +385,7 @@ class BranchingSelectSerializer(serializers.ModelSerializer):
         return local_ids
 
     def validate(self, validated_data: dict) -> dict:
-        profile: Profile = self.context["request"].user.profile.get(course_id=1)
+        profile: Profile = self.context["request"].profile
         blocks = self._get_blocks(validated_data['choose_local_id'])
 
         if self.instance.type == BranchingType.one_from_n.value:
@@ -308,7 +394,7 @@ class BranchingSelectSerializer(serializers.ModelSerializer):
 
         elif self.instance.type == BranchingType.six_from_n.value:
             block_counts = sum([
-                len(CourseLessonsTree(block).get_map_for_profile(profile)) if isinstance(block, Quest)
+                get_quest_tree(block).get_summary(profile).block_count if isinstance(block, Quest)
                 else 1
                 for block in blocks
             ])
@@ -325,10 +411,8 @@ class BranchingSelectSerializer(serializers.ModelSerializer):
             process_affect(block.profile_affect, profile)
 
     def _collect_quest_price(self, quest: Quest) -> int:
-        quest_tree = CourseLessonsTree(quest)
-        profile = self.context['request'].user.profile.get(course_id=1)
-        map_list = quest_tree.get_map_for_profile(profile)
-        return sum([l.money_cost for l in map_list if isinstance(l, Lesson)])
+        profile = self.context['request'].profile
+        return get_quest_tree(quest).get_summary(profile).money_cost
 
     def _get_blocks_total_price(self, blocks: list[Quest | Lesson]) -> int:
         total_lessons_price = 0
@@ -340,29 +424,31 @@ class BranchingSelectSerializer(serializers.ModelSerializer):
         return total_lessons_price
 
     def update(self, branching: Branching, validated_data: dict) -> Branching:
-        profile: Profile = self.context["request"].user.profile.get(course_id=1)
+        profile: Profile = self.context["request"].profile
         choose_local_id = validated_data["choose_local_id"]
 
-        profile_branching = ProfileBranchingChoice.objects.filter(profile=profile, branching=branching)
-        if profile_branching.exists():
-            raise BranchingAlreadyChosenException("You have already selected this branching")
-
         local_ids = ",".join(list(map(lambda x: x.strip(), choose_local_id.split(","))))
         blocks = self._get_blocks(local_ids)
-
-        profile_resources = profile.resources
         branching_price = self._get_blocks_total_price(blocks)
-        if profile_resources.money_amount < branching_price:
-            raise NotEnoughMoneyException("Not enough money to select this branching")
 
+        # выбор и списание либо проходят вместе, либо не проходят: повторный запрос упрется в unique
         with transaction.atomic():
-            profile_resources.money_amount -= branching_price
-            profile_resources.save()
+            try:
+                with transaction.atomic():
+                    ProfileBranchingChoice.objects.create(
+                        profile=profile, branching=branching, choose_local_id=choose_local_id
+                    )
+            except IntegrityError:
+                raise BranchingAlreadyChosenException("You have already selected this branching")
+
+            is_paid = change_resources(
+                profile.id, ResourcesEventReason.BRANCHING, money=-branching_price, strict=True
+            )
 
-            profile_branching = ProfileBranchingChoice.objects.create(profile=profile, branching=branching)
-            profile_branching.choose_local_id = choose_local_id
-            profile_branching.save()
+            if not is_paid:
+                raise NotEnoughMoneyException("Not enough money to select this branching")
 
+        profile.resources.refresh_from_db(fields=["money_amount"])
         self._process_callbacks(blocks, profile)
         return branching
 
@@ -376,18 +462,36 @@ class CourseMapSerializer(serializers.ModelSerializer):
         model = Course
         fields = ["map", "active", "locales"]
 
+    def _get_progress(self) -> ProfileCourseProgress:
+        if not hasattr(self, "_progress"):
+            self._progress = ProfileCourseProgress(self.context['request'].profile)
+
+        return self._progress
+
     def get_map(self, obj: Course) -> list[dict]:
+        """
+            Сериализованная карта общая для профилей с одинаковым отпечатком (см. get_map_fingerprint)
+        """
+        request = self.context['request']
+        progress = self._get_progress()
+        tree = get_course_tree(obj.id)
+
+        cache_key = f"course_map:{obj.id}:{request.get_host()}:{tree.get_map_fingerprint(progress.profile, progress)}"
+        serialized_map_list = cache.get(cache_key)
+
+        if serialized_map_list is None:
+            serialized_map_list = self._serialize_map(tree, tree.get_map_for_profile(progress.profile, progress))
+            cache.set(cache_key, serialized_map_list, timeout=settings.COURSE_MAP_CACHE_TTL)
+
+        return serialized_map_list
+
+    def _serialize_map(self, tree: CourseLessonsTree, map_list: list[Lesson | Branching]) -> list[dict]:
         model_to_serializer = {
             Lesson: CourseMapLessonCell,
             Branching: CourseMapBranchingCell,
         }
 
-        profile: Profile = self.context['request'].user.profile.get(course_id=1)
-        tree = CourseLessonsTree(obj)
-
-        map_list = tree.get_map_for_profile(profile)
-
-        course_map_images = CourseMapImg.objects.filter(course=obj).all()
+        course_map_images = tree.map_images
         course_map_images_data = CourseMapImgCell(course_map_images, many=True, context=self.context).data
         serialized_map_list = [None] * (tree.get_max_depth() + len(course_map_images))
 
@@ -408,9 +512,9 @@ class CourseMapSerializer(serializers.ModelSerializer):
         return serialized_map_list
 
     def get_active(self, obj: Course) -> int:
-        profile: Profile = self.context['request'].user.profile.get(course_id=1)
-        tree = CourseLessonsTree(obj)
-        active_block_index = tree.get_active(profile)
+        progress = self._get_progress()
+        tree = get_course_tree(obj.id)
+        active_block_index = tree.get_active(progress.profile, progress)
         return active_block_index
 
 
@@ -461,15 +565,20 @@ class LessonFinishSerializer(serializers.ModelSerializer):
     emotion = EmotionDataSerializer(write_only=True)
     duration = serializers.IntegerField(write_only=True)
 
-    @lru_cache
-    def get_next_obj(self, lesson: Lesson):
-        course_map = CourseLessonsTree(lesson.course)
-        profile = self.context["profile"]
-        map_list = course_map.get_map_for_profile(profile)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._next_objs: dict[int, Lesson | Branching | None] = {}
+
+    def get_next_obj(self, lesson: Lesson) -> Lesson | Branching | None:
+        """
+            Следующий блок карты, общий для next_id, next_type и salary_amount
+        """
+        if lesson.id not in self._next_objs:
+            self._next_objs[lesson.id] = get_course_tree(lesson.course_id).get_next_block(
+                self.context["profile"], lesson.local_id, self.context.get("progress")
+            )
 
-        for i, block in enumerate(map_list):
-            if i + 1 < len(map_list) and block.local_id == lesson.local_id:
-                return map_list[i + 1]
+        return self._next_objs[lesson.id]
 
     def get_salary_amount(self, lesson: Lesson) -> int:
         salary_amount = 0
@@ -549,13 +658,13 @@ class ProfileLessonSerializer(serializers.ModelSerializer):
     done = serializers.SerializerMethodField()
 
     def get_unit_count(self, lesson: Lesson) -> int:
-        return lesson.unit_set.count()
+        return lesson.unit_count
 
     def get_bonuses(self, lesson: Lesson) -> dict:
         if self.context.get("finished", False):
             return {"energy": 0, "money": 0}
 
-        profile = self.context["request"].user.profile.get()
+        profile = self.context["request"].profile
 
         if not profile.scientific_director_id:
             return {"energy": 0, "money": 0}
@@ -565,12 +674,10 @@ class ProfileLessonSerializer(serializers.ModelSerializer):
         return lesson.bonuses[scientific_director_id]
 
     def get_done(self, lesson: Lesson) -> bool:
+        if "done_lessons" not in self.context:
+            self.context["done_lessons"] = ProfileCourseProgress(self.context['request'].profile).done_lessons
 
-        profile = self.context['request'].user.profile.get()
-        lesson_done = ProfileLessonDone.objects.filter(profile=profile, lesson=lesson).first()
-        if lesson_done:
-            return True
-        return False
+        return lesson.id in self.context["done_lessons"]
 
     class Meta:
 
@@ -601,7 +708,10 @@ class ProfileBranchingSerializer(serializers.ModelSerializer):
     # TODO: добавить два типа бранчей
 
     def get_selected(self, branching: Branching) -> bool:
-        profile = self.context['request'].user.profile.get()
+        profile = self.context['request'].profile
+
+        if branching.type in (2, 3) and "branching_choices" in self.context:
+            return self.context["branching_choices"].get(branching.id, False)
 
         if branching.type in (2, 3):
             branching_choice = ProfileBranchingChoice.objects.filter(profile=profile, branching=branching).first()
@@ -682,7 +792,9 @@ class SavedProfileLessonSerializer(serializers.ModelSerializer):
         fields = ['id', 'location', 'npc', 'lesson_name', 'lesson_number', 'quest_number', 'locales', 'chunk']
 
     def get_chunk(self, obj):
-        sorted_chunks = obj.chunk.order_by('id')
+        from helpers.lesson_tree import rehydrate_chunks
+
+        sorted_chunks = rehydrate_chunks(self.context.get("lesson"), list(obj.chunk.order_by('id').values()))
         serializer = SavedProfileLessonChunkSerializer(sorted_chunks, many=True)
 
         return serializer.data
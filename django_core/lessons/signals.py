@@ -1,10 +1,25 @@
 from typing import Literal, Tuple
 
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
-from lessons.models import Question, Review, EmailTypes
+from lessons.models import (
+    Question,
+    Review,
+    EmailTypes,
+    Course,
+    Quest,
+    Lesson,
+    Branching,
+    ProfileBranchingChoice,
+    ProfileLessonDone,
+    CourseMapImg,
+    Unit,
+)
 from lessons.tasks import send_message
+from helpers.course_tree import invalidate_course_tree, invalidate_profile_progress, reset_done_lessons
+from helpers.lesson_tree import invalidate_lesson_units
 
 
 def prepare_data(*, instance: Review | Question, feedback_type: Literal["review", "question"]) -> Tuple[str, str, str]:
@@ -39,3 +54,47 @@ def send_email_after_review_created(sender, instance: Review, **kwargs: dict) ->
 def send_email_after_question_created(sender, instance: Question, **kwargs: dict) -> None:
     subject, msg, mail_type = prepare_data(instance=instance, feedback_type="question")
     send_message.delay(subject, msg, mail_type)
+
+
+@receiver([post_save, post_delete], sender=Course)
+def invalidate_course_tree_on_course_change(sender, instance: Course, **kwargs: dict) -> None:
+    course_id = instance.id
+    transaction.on_commit(lambda: invalidate_course_tree(course_id))
+
+
+@receiver([post_save, post_delete], sender=Quest)
+@receiver([post_save, post_delete], sender=Lesson)
+@receiver([post_save, post_delete], sender=Branching)
+def invalidate_course_tree_on_block_change(sender, instance: Quest | Lesson | Branching, **kwargs: dict) -> None:
+    course_id = instance.course_id
+    transaction.on_commit(lambda: invalidate_course_tree(course_id))
+
+
+@receiver([post_save, post_delete], sender=CourseMapImg)
+def invalidate_course_tree_on_map_image_change(sender, instance: CourseMapImg, **kwargs: dict) -> None:
+    course_id = instance.course_id
+    transaction.on_commit(lambda: invalidate_course_tree(course_id))
+
+
+@receiver([post_save, post_delete], sender=Unit)
+def invalidate_lesson_units_on_unit_change(sender, instance: Unit, **kwargs: dict) -> None:
+    lesson_id = instance.lesson_id
+    transaction.on_commit(lambda: invalidate_lesson_units(lesson_id))
+
+
+@receiver([post_save, post_delete], sender=ProfileBranchingChoice)
+@receiver([post_save, post_delete], sender=ProfileLessonDone)
+def invalidate_profile_progress_on_change(
+    sender,
+    instance: ProfileBranchingChoice | ProfileLessonDone,
+    **kwargs: dict
+) -> None:
+    # версия меняется только после коммита: иначе запрос, прочитавший старые строки
+    # до коммита, закэшировал бы их под новой версией
+    profile_id = instance.profile_id
+    transaction.on_commit(lambda: invalidate_profile_progress(profile_id))
+
+
+@receiver(post_delete, sender=ProfileLessonDone)
+def reset_done_lessons_on_delete(sender, instance: ProfileLessonDone, **kwargs: dict) -> None:
+    reset_done_lessons(instance.profile_id)
@@ -1,6 +1,7 @@
 import random
 from abc import abstractmethod
-from collections import defaultdict
+from collections import defaultdict, Counter
+from functools import cached_property
 
 from django.db import models
 from lessons.structures import LessonBlockType
@@ -9,6 +10,10 @@ from lessons.models import default_locale
 
 
 class TaskBlock(models.Model, ChildAccessMixin):
+    """
+        Задание урока. Данные для проверки ответа (cached_property) готовятся один раз на экземпляр,
+        экземпляры заданий хранятся в скомпилированном уроке (см. helpers.lesson_tree)
+    """
     title = models.CharField(max_length=127)
     description = models.TextField()
     if_correct = models.CharField(max_length=1023)
@@ -21,7 +26,7 @@ class TaskBlock(models.Model, ChildAccessMixin):
     def get_details(self, answer):
         pass
 
-    def shuffle_content(self, content: dict) -> dict:
+    def shuffle_content(self, content: dict, rng: random.Random = None) -> dict:
         return content
 
     class Meta:
@@ -38,16 +43,10 @@ class RadiosBlock(TaskBlock):
         return self.correct == str(answer)
 
     def get_details(self, answer: str) -> dict[str, bool]:
-        m_variants = {v["id"]: v for v in self.variants}
         if self.check_answer(answer):
             return {answer: True}
 
-        answer = str(answer)
-
-        if answer not in m_variants:
-            return {answer: False}
-
-        return {answer: False}
+        return {str(answer): False}
 
 
 class CheckboxesBlock(TaskBlock):
@@ -56,23 +55,35 @@ class CheckboxesBlock(TaskBlock):
     variants = models.JSONField()
     correct = models.JSONField()
 
+    @cached_property
+    def variant_ids(self) -> frozenset[str]:
+        return frozenset(v["id"] for v in self.variants)
+
+    @cached_property
+    def correct_ids(self) -> frozenset[str]:
+        return frozenset(self.correct)
+
+    @cached_property
+    def correct_counts(self) -> Counter:
+        return Counter(self.correct)
+
     def check_answer(self, answer: list[str]) -> bool:
-        return sorted(answer) == sorted(self.correct)
+        # сравнение мультимножеств, как и сравнение отсортированных списков
+        return len(answer) == len(self.correct) and Counter(answer) == self.correct_counts
 
     def get_details(self, answer: list[str]) -> dict[str, bool]:
-        m_variants = {v["id"]: v for v in self.variants}
         details = {}
 
         has_false = False
 
         for answer_item in answer:
-            if answer_item not in m_variants:
+            if answer_item not in self.variant_ids:
                 details[answer_item] = False
                 has_false = True
                 continue
 
-            details[answer_item] = answer_item in self.correct
-            has_false = has_false or (answer_item not in self.correct)
+            details[answer_item] = answer_item in self.correct_ids
+            has_false = has_false or (answer_item not in self.correct_ids)
 
         has_false = has_false or (not self.check_answer(answer))
 
@@ -111,9 +122,12 @@ class InputBlock(TaskBlock):
 
     correct = models.JSONField(default=default_locale)
 
+    @cached_property
+    def accepted_answers(self) -> frozenset[str]:
+        return frozenset(v.lower() for v in (*self.correct['ru'], *self.correct['en']))
+
     def check_answer(self, answer):
-        return (answer.lower() in
-                [v.lower() for v in (*self.correct['ru'], *self.correct['en'])])
+        return answer.lower() in self.accepted_answers
 
 
 class NumberBlock(TaskBlock):
@@ -122,10 +136,14 @@ class NumberBlock(TaskBlock):
     tolerance = models.FloatField()
     correct = models.FloatField()
 
-    def check_answer(self, answer):
+    @cached_property
+    def bounds(self) -> tuple[float, float]:
         dx = self.correct * self.tolerance
+        return self.correct - dx, self.correct + dx
 
-        return self.correct - dx <= answer <= self.correct + dx
+    def check_answer(self, answer):
+        lower, upper = self.bounds
+        return lower <= answer <= upper
 
 
 class RadiosTableBlock(TaskBlock):
@@ -136,9 +154,17 @@ class RadiosTableBlock(TaskBlock):
     is_radio = models.BooleanField()
     correct = models.JSONField()
 
+    @cached_property
+    def correct_rows(self) -> dict[str, Counter]:
+        return {row: Counter(variants) for row, variants in self.correct.items()}
+
+    @cached_property
+    def correct_row_sets(self) -> dict[str, frozenset[str]]:
+        return {row: frozenset(variants) for row, variants in self.correct.items()}
+
     def check_answer(self, answer: dict[str, list[str]]) -> bool:
         for row, choose in answer.items():
-            if sorted(self.correct[row]) != sorted(choose):
+            if len(choose) != len(self.correct[row]) or Counter(choose) != self.correct_rows[row]:
                 return False
 
         return True
@@ -147,8 +173,10 @@ class RadiosTableBlock(TaskBlock):
         details = defaultdict(lambda: defaultdict(bool))
 
         for row, choose in answer.items():
+            correct_row = self.correct_row_sets[row]
+
             for variant in choose:
-                details[row][variant] = variant in self.correct[row]
+                details[row][variant] = variant in correct_row
 
         return details
 
@@ -171,16 +199,18 @@ class SortBlock(TaskBlock):
     options = models.JSONField()
     correct = models.JSONField()
 
-    def shuffle_content(self, content: dict) -> dict:
+    def shuffle_content(self, content: dict, rng: random.Random = None) -> dict:
+        rng = rng or random
+
         if len(content["options"]) == 1:
             return content["options"]
 
-        random.shuffle(content["options"])
+        rng.shuffle(content["options"])
 
         answer = list(map(lambda x: x["id"], content["options"]))
 
         if self.check_answer(answer):
-            return self.shuffle_content(content)
+            return self.shuffle_content(content, rng)
 
         return content
 
@@ -206,29 +236,32 @@ class ComparisonBlock(TaskBlock):
     def check_answer(self, answer: list[tuple[str, str]]) -> bool:
         return len(self.get_details(answer)) == len(self.correct)
 
-    def get_details(self, answer: list[tuple[str, str]]) -> list[int]:
-        numbers = []
-
-        m_correct = {
+    @cached_property
+    def correct_pairs(self) -> dict[str, str]:
+        return {
             **{option_1: option_2 for option_1, option_2 in self.correct},
             **{option_2: option_1 for option_1, option_2 in self.correct}
         }
 
+    def get_details(self, answer: list[tuple[str, str]]) -> list[int]:
+        numbers = []
+
         for i, (option_1, option_2) in enumerate(answer):
-            if m_correct[option_1] == option_2:
+            if self.correct_pairs[option_1] == option_2:
                 numbers.append(i)
 
         return numbers
 
-    def shuffle_content(self, content: dict) -> dict:
+    def shuffle_content(self, content: dict, rng: random.Random = None) -> dict:
+        rng = rng or random
         options_1 = content["lists"][0]
         options_2 = content["lists"][1]
 
         if len(options_1) == 1 and len(options_2) == 1:
             return content
 
-        random.shuffle(options_1)
-        random.shuffle(options_2)
+        rng.shuffle(options_1)
+        rng.shuffle(options_2)
 
         answer = list(zip(
             list(map(lambda x: x["id"], options_1)),
@@ -236,6 +269,13 @@ class ComparisonBlock(TaskBlock):
         ))
 
         if self.check_answer(answer):
-            return self.shuffle_content(content)
+            return self.shuffle_content(content, rng)
 
         return content
+
+
+# Модели заданий по типу юнита (300-399), собираются один раз при импорте
+TASK_MODELS: dict[int, type[TaskBlock]] = {
+    task_model.type.value: task_model
+    for task_model in TaskBlock.get_all_subclasses()
+}
@@ -0,0 +1,412 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from accounts.models import Profile
+from lessons.models import (
+    Lesson,
+    LessonBlock,
+    Course,
+    Quest,
+    Branching,
+    ProfileBranchingChoice,
+    ProfileLessonDone,
+    CourseMapImg,
+)
+from lessons.exceptions import BranchingAlreadyChosenException
+from lessons.serializers import (
+    NewCourseMapSerializer,
+    LessonFinishSerializer,
+    BranchingDetailSerializer,
+    BranchingSelectSerializer,
+)
+from resources.exceptions import NotEnoughMoneyException
+from lessons.structures import BranchingType, BranchingViewType
+from lessons.views import NewCourseMapViewSet
+from helpers.course_tree import (get_course_tree, get_course_version, invalidate_course_tree,
+                                 get_profile_progress_version, mark_lesson_done, ProfileCourseProgress)
+from helpers.testing import OnCommitCallbacksMixin
+
+
+class CourseTreeTestCase(OnCommitCallbacksMixin, TestCase):
+    """
+        Курс: l_001 -> b_001 (один из двух уроков) -> q_001 (l_004 -> l_005) -> l_006
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = Course.objects.create(name="test", description="test", entry="l_001")
+        cls.quest = Quest.objects.create(
+            course=cls.course, local_id="q_001", name="q_001_name",
+            description="fixture", entry="l_004", next="l_006"
+        )
+
+        cls._create_lesson("l_001", "b_001")
+        cls._create_lesson("l_002", "q_001")
+        cls._create_lesson("l_003", "q_001")
+        cls._create_lesson("l_004", "l_005", quest=cls.quest)
+        cls._create_lesson("l_005", "", quest=cls.quest)
+        cls._create_lesson("l_006", "")
+
+        cls.branching = Branching.objects.create(
+            course=cls.course, local_id="b_001",
+            type=BranchingType.one_from_n.value,
+            content={"next": ["l_002", "l_003"]}
+        )
+        cls.profile = Profile.objects.create(course=cls.course)
+
+    def setUp(self) -> None:
+        # идентификаторы курсов в тестовой БД переиспользуются
+        invalidate_course_tree(self.course.id)
+
+    @classmethod
+    def _create_lesson(cls, local_id: str, next_id: str, quest: Quest = None) -> Lesson:
+        return Lesson.objects.create(
+            course=cls.course, quest=quest, local_id=local_id,
+            name=f"{local_id}_name", description="fixture",
+            time_cost=0, money_cost=0, energy_cost=0,
+            next=next_id, content=LessonBlock.objects.create()
+        )
+
+    def _get_map_local_ids(self) -> list[str]:
+        course_tree = get_course_tree(self.course.id)
+        return [block.local_id for block in course_tree.get_map_for_profile(self.profile)]
+
+    def test_course_tree_is_compiled_once(self) -> None:
+        course_tree = get_course_tree(self.course.id)
+
+        with self.assertNumQueries(0):
+            self.assertIs(get_course_tree(self.course.id), course_tree)
+
+        self.assertIn(self.quest.local_id, course_tree.quest_trees)
+
+    def test_course_tree_is_rebuilt_after_invalidation(self) -> None:
+        course_tree = get_course_tree(self.course.id)
+        invalidate_course_tree(self.course.id)
+
+        self.assertIsNot(get_course_tree(self.course.id), course_tree)
+
+    def test_map_stops_on_unselected_branching(self) -> None:
+        self.assertEqual(self._get_map_local_ids(), ["l_001", "b_001"])
+
+    def test_map_walks_into_quest_after_choice(self) -> None:
+        ProfileBranchingChoice.objects.create(
+            profile=self.profile, branching=self.branching, choose_local_id="l_003"
+        )
+
+        self.assertEqual(
+            self._get_map_local_ids(),
+            ["l_001", "b_001", "l_003", "l_004", "l_005", "l_006"]
+        )
+
+    def test_course_version_is_bumped_after_commit(self) -> None:
+        version = get_course_version(self.course.id)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                Lesson.objects.filter(local_id="l_006").first().save()
+                self.assertEqual(get_course_version(self.course.id), version)
+
+        self.assertEqual(get_course_version(self.course.id), version)
+
+        for callback in callbacks:
+            callback()
+
+        self.assertNotEqual(get_course_version(self.course.id), version)
+
+    def test_progress_is_not_cached_under_uncommitted_version(self) -> None:
+        course_tree = get_course_tree(self.course.id)
+        version = get_profile_progress_version(self.profile.id)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                ProfileBranchingChoice.objects.create(
+                    profile=self.profile, branching=self.branching, choose_local_id="l_002"
+                )
+                # чтение до коммита видит прежнюю версию и не может занять новую
+                self.assertEqual(get_profile_progress_version(self.profile.id), version)
+
+        self.assertEqual(len(callbacks), 1)
+
+        for callback in callbacks:
+            callback()
+
+        progress = ProfileCourseProgress(self.profile)
+        self.assertNotEqual(progress.version, version)
+        self.assertEqual(
+            [block.local_id for block in course_tree.get_map_for_profile(self.profile, progress)],
+            ["l_001", "b_001", "l_002", "l_004", "l_005", "l_006"]
+        )
+
+    def test_map_is_resolved_with_constant_queries(self) -> None:
+        ProfileBranchingChoice.objects.create(
+            profile=self.profile, branching=self.branching, choose_local_id="l_002"
+        )
+        course_tree = get_course_tree(self.course.id)
+
+        # для карты достаточно выборов ветвлений
+        with self.assertNumQueries(1):
+            course_tree.get_map_for_profile(self.profile)
+
+    def test_map_is_memoized_until_progress_changes(self) -> None:
+        course_tree = get_course_tree(self.course.id)
+        course_tree.get_map_for_profile(self.profile)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self._get_map_local_ids(), ["l_001", "b_001"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ProfileBranchingChoice.objects.create(
+                profile=self.profile, branching=self.branching, choose_local_id="l_002"
+            )
+
+        self.assertEqual(
+            self._get_map_local_ids(),
+            ["l_001", "b_001", "l_002", "l_004", "l_005", "l_006"]
+        )
+
+    def test_progress_snapshot_is_built_in_one_pass(self) -> None:
+        ProfileLessonDone.objects.create(profile=self.profile, lesson=Lesson.objects.get(local_id="l_001"))
+        course_tree = get_course_tree(self.course.id)
+
+        # выборы ветвлений, пройденные уроки и порядок картинок карты
+        with self.assertNumQueries(3):
+            snapshot = course_tree.get_progress_snapshot(self.profile)
+
+        self.assertEqual(snapshot.positions, {"l_001": 0, "b_001": 1})
+        self.assertEqual(snapshot.interacted, {"l_001"})
+        self.assertEqual(snapshot.active, 1)
+
+        with self.assertNumQueries(0):
+            self.assertIs(course_tree.get_progress_snapshot(self.profile), snapshot)
+
+    def test_active_is_shifted_by_cached_map_images(self) -> None:
+        for order in (2, 0):
+            CourseMapImg.objects.create(course=self.course, order=order, image="map.png", image_disabled="map.png")
+
+        ProfileLessonDone.objects.create(profile=self.profile, lesson=Lesson.objects.get(local_id="l_001"))
+        course_tree = get_course_tree(self.course.id)
+        self.assertEqual(course_tree.map_image_orders, [0, 2])
+
+        # картинки уже загружены вместе с графом курса
+        with self.assertNumQueries(2):
+            self.assertEqual(course_tree.get_active(self.profile), 3)
+
+    def test_course_map_is_serialized_with_constant_queries(self) -> None:
+        ProfileLessonDone.objects.create(profile=self.profile, lesson=Lesson.objects.get(local_id="l_001"))
+        ProfileBranchingChoice.objects.create(
+            profile=self.profile, branching=self.branching, choose_local_id="l_002"
+        )
+
+        view = NewCourseMapViewSet(request=RequestFactory().get("/"), format_kwarg=None, kwargs={})
+        view.request.profile = self.profile
+        get_course_tree(self.course.id)
+
+        # курс и пять предзагрузок, пройденные уроки и выборы ветвлений
+        with self.assertNumQueries(8):
+            course_map = NewCourseMapSerializer(
+                view.get_queryset().get(id=self.course.id), context=view.get_serializer_context()
+            ).data
+
+        lessons = {lesson["local_id"]: lesson for lesson in course_map["lessons"]}
+        self.assertTrue(lessons["l_001"]["done"])
+        self.assertFalse(lessons["l_002"]["done"])
+        self.assertEqual(course_map["branchings"][0]["selected"], "l_002")
+
+    def test_map_fingerprint_is_shared_by_same_choices(self) -> None:
+        other_profile = Profile.objects.create(course=self.course, gender="female")
+        course_tree = get_course_tree(self.course.id)
+
+        # ветвлений по параметрам профиля в курсе нет, пол на карту не влияет
+        self.assertEqual(
+            course_tree.get_map_fingerprint(self.profile),
+            course_tree.get_map_fingerprint(other_profile)
+        )
+
+        ProfileBranchingChoice.objects.create(
+            profile=other_profile, branching=self.branching, choose_local_id="l_002"
+        )
+
+        self.assertNotEqual(
+            course_tree.get_map_fingerprint(self.profile),
+            course_tree.get_map_fingerprint(other_profile)
+        )
+
+    def test_done_lessons_are_read_without_writes(self) -> None:
+        ProfileLessonDone.objects.create(profile=self.profile, lesson=Lesson.objects.get(local_id="l_001"))
+
+        with CaptureQueriesContext(connection) as queries:
+            done_lessons = ProfileCourseProgress(self.profile).done_lessons
+
+        self.assertEqual(len(done_lessons), 1)
+        self.assertFalse([query for query in queries if not query["sql"].startswith("SELECT")])
+
+    def test_done_lessons_bitset_is_persisted_on_finish(self) -> None:
+        first_lesson = Lesson.objects.get(local_id="l_001")
+        final_quest_lesson = Lesson.objects.get(local_id="l_005")
+        course_tree = get_course_tree(self.course.id)
+
+        with transaction.atomic():
+            self.assertTrue(mark_lesson_done(self.profile, first_lesson.id))
+            ProfileLessonDone.objects.create(profile=self.profile, lesson=first_lesson)
+
+        self.assertFalse(mark_lesson_done(self.profile, first_lesson.id))
+        self.profile.refresh_from_db()
+
+        with self.assertNumQueries(0):
+            done_lessons = ProfileCourseProgress(self.profile).done_lessons
+
+        self.assertIn(first_lesson.id, done_lessons)
+        self.assertNotIn(final_quest_lesson.id, done_lessons)
+        self.assertEqual(len(done_lessons & course_tree.quest_final_lessons), 0)
+
+        with transaction.atomic():
+            self.assertTrue(mark_lesson_done(self.profile, final_quest_lesson.id))
+            ProfileLessonDone.objects.create(profile=self.profile, lesson=final_quest_lesson)
+
+        done_lessons = ProfileCourseProgress(self.profile).done_lessons
+        self.assertEqual(len(done_lessons), 2)
+        self.assertEqual(len(done_lessons & course_tree.quest_final_lessons), 1)
+
+    def test_done_lessons_outside_course_are_not_counted(self) -> None:
+        other_course = Course.objects.create(name="other", description="other")
+        other_lesson = Lesson.objects.create(
+            course=other_course, local_id="l_001", name="other_name", description="fixture",
+            time_cost=0, money_cost=0, energy_cost=0, next="", content=LessonBlock.objects.create()
+        )
+        first_lesson = Lesson.objects.get(local_id="l_001", course=self.course)
+
+        for lesson in (other_lesson, first_lesson):
+            with transaction.atomic():
+                self.assertTrue(mark_lesson_done(self.profile, lesson.id))
+                ProfileLessonDone.objects.create(profile=self.profile, lesson=lesson)
+
+        self.assertFalse(mark_lesson_done(self.profile, other_lesson.id))
+
+        # маска из профиля и собранная из таблицы дают одно и то же
+        self.profile.refresh_from_db()
+        stored_count = len(ProfileCourseProgress(self.profile).done_lessons)
+        self.profile.lessons_done_version = ""
+        self.assertEqual(len(ProfileCourseProgress(self.profile).done_lessons), stored_count)
+        self.assertEqual(stored_count, 1)
+
+    def test_done_lessons_bitset_is_reset_on_delete(self) -> None:
+        first_lesson = Lesson.objects.get(local_id="l_001")
+
+        with transaction.atomic():
+            mark_lesson_done(self.profile, first_lesson.id)
+            done = ProfileLessonDone.objects.create(profile=self.profile, lesson=first_lesson)
+
+        done.delete()
+        self.profile.refresh_from_db()
+
+        self.assertNotIn(first_lesson.id, ProfileCourseProgress(self.profile).done_lessons)
+
+    def test_finished_lesson_successor_is_resolved_once(self) -> None:
+        lesson = Lesson.objects.select_related("profile_affect").get(local_id="l_001")
+        progress = ProfileCourseProgress(self.profile)
+        get_course_tree(self.course.id).get_progress_snapshot(self.profile, progress)
+
+        with self.assertNumQueries(0):
+            finish_data = LessonFinishSerializer(lesson, context={"profile": self.profile, "progress": progress}).data
+
+        self.assertEqual(finish_data["next_id"], "b_001")
+        self.assertEqual(finish_data["salary_amount"], 0)
+
+    def test_branching_choices_are_built_from_compiled_course(self) -> None:
+        branching = Branching.objects.select_related("course").get(id=self.branching.id)
+        request = RequestFactory().get("/")
+        request.profile = self.profile
+        get_course_tree(self.course.id)
+
+        with self.assertNumQueries(0):
+            branching_data = BranchingDetailSerializer(branching, context={"request": request}).data
+
+        self.assertEqual(branching_data["type"], BranchingViewType.lessons_fork.value)
+        self.assertEqual([choice["id"] for choice in branching_data["choices"]], ["l_002", "l_003"])
+
+    def test_branching_payload_is_read_from_cache_once(self) -> None:
+        branching = Branching.objects.select_related("course").get(id=self.branching.id)
+        request = RequestFactory().get("/")
+        request.profile = self.profile
+        progress = ProfileCourseProgress(self.profile)
+
+        context = {"request": request, "progress": progress, "branching_choices": {}}
+
+        with mock.patch("lessons.serializers.cache", wraps=cache) as shared_cache:
+            serializer = BranchingDetailSerializer(branching, context=context)
+            serializer.data
+
+        shared_cache.get.assert_called_once()
+        self.assertIs(serializer.context["progress"], progress)
+        # выборы профиля в том же контексте не перезаписываются
+        self.assertEqual(serializer.context["branching_choices"], {})
+
+    def test_quest_choice_price_is_taken_from_summary(self) -> None:
+        Lesson.objects.filter(local_id="l_004").update(money_cost=100)
+        invalidate_course_tree(self.course.id)
+        fork = Branching.objects.create(
+            course=self.course, local_id="b_002",
+            type=BranchingType.one_from_n.value,
+            content={"next": ["q_001", "l_006"]}
+        )
+        request = RequestFactory().get("/")
+        request.profile = self.profile
+        quest_tree = get_course_tree(self.course.id).get_quest_tree(self.quest)
+
+        with mock.patch.object(type(quest_tree), "get_summary", wraps=quest_tree.get_summary) as get_summary:
+            branching_data = BranchingDetailSerializer(fork, context={"request": request}).data
+
+        get_summary.assert_called_once()
+        [quest_data] = [choice for choice in branching_data["choices"] if choice["type"] == "quest"]
+        self.assertEqual(quest_data["money_cost"], 100)
+
+    def test_quest_summary_is_stored_in_compiled_course(self) -> None:
+        Lesson.objects.filter(local_id="l_004").update(money_cost=100)
+        invalidate_course_tree(self.course.id)
+        quest_tree = get_course_tree(self.course.id).get_quest_tree(self.quest)
+
+        summary = quest_tree.get_summary(self.profile)
+        self.assertEqual((summary.block_count, summary.money_cost), (2, 100))
+
+        with self.assertNumQueries(0):
+            self.assertIs(quest_tree.get_summary(Profile(course=self.course)), summary)
+
+    def _select_branching(self, choose_local_id: str) -> None:
+        request = RequestFactory().patch("/")
+        request.profile = self.profile
+
+        serializer = BranchingSelectSerializer(
+            self.branching, data={"choose_local_id": choose_local_id}, context={"request": request}
+        )
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+
+    def test_branching_is_selected_and_paid_once(self) -> None:
+        Lesson.objects.filter(local_id="l_002").update(money_cost=100)
+        self.profile.resources.money_amount = 150
+        self.profile.resources.save()
+        invalidate_course_tree(self.course.id)
+
+        self._select_branching("l_002")
+
+        with self.assertRaises(BranchingAlreadyChosenException):
+            self._select_branching("l_002")
+
+        self.profile.resources.refresh_from_db()
+        self.assertEqual(self.profile.resources.money_amount, 50)
+        self.assertEqual(ProfileBranchingChoice.objects.get(profile=self.profile).choose_local_id, "l_002")
+
+    def test_branching_is_not_selected_without_money(self) -> None:
+        Lesson.objects.filter(local_id="l_002").update(money_cost=100)
+        self.profile.resources.money_amount = 50
+        self.profile.resources.save()
+        invalidate_course_tree(self.course.id)
+
+        with self.assertRaises(NotEnoughMoneyException):
+            self._select_branching("l_002")
+
+        self.assertFalse(ProfileBranchingChoice.objects.filter(profile=self.profile).exists())
@@ -0,0 +1,147 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, RequestFactory
+from rest_framework.test import force_authenticate
+
+from accounts.models import Profile
+from lessons.models import Lesson, LessonBlock, Course, Unit, ProfileLesson, ProfileLessonChunk
+from lessons.structures import LessonBlockType
+from lessons.structures.tasks import SortBlock
+from lessons.views import LessonDetailViewSet
+from helpers.course_tree import invalidate_course_tree
+from helpers.lesson_tree import invalidate_lesson_units, rehydrate_chunks as real_rehydrate_chunks
+
+User = get_user_model()
+
+
+class LessonDetailViewTestCase(TestCase):
+    """
+        Урок: u_001 (реплика) -> u_002 (задание на сортировку) -> u_003 (реплика с наградой)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = Course.objects.create(
+            name="test", description="test", entry="l_001",
+            locale={"ru": {"l_001_name": "урок"}, "en": {"l_001_name": "lesson"}}
+        )
+        cls.lesson = Lesson.objects.create(
+            course=cls.course, local_id="l_001", name="l_001_name", description="fixture",
+            time_cost=0, money_cost=0, energy_cost=0, next="",
+            content=LessonBlock.objects.create(entry="u_001")
+        )
+        options = [{"id": option_id} for option_id in ("a", "b", "c")]
+        sort_task = SortBlock.objects.create(
+            title="sort", description="fixture", if_correct="", if_incorrect="",
+            options=options, correct=["a", "b", "c"]
+        )
+        Unit.objects.create(
+            lesson=cls.lesson, lesson_block=cls.lesson.content, local_id="u_001",
+            type=LessonBlockType.replica.value, content={"message": "u_001"}, next=["u_002"]
+        )
+        Unit.objects.create(
+            lesson=cls.lesson, lesson_block=cls.lesson.content, local_id="u_002",
+            type=LessonBlockType.sort.value, next=["u_003"],
+            content={"id": sort_task.id, "options": options, "correct": ["a", "b", "c"]}
+        )
+        Unit.objects.create(
+            lesson=cls.lesson, lesson_block=cls.lesson.content, local_id="u_003",
+            type=LessonBlockType.replica.value, content={"message": "u_003", "money": 10}, next=[]
+        )
+
+        User.objects.bulk_create([User(username="test1", email="test1@mail.ru")])
+        cls.user = User.objects.get(username="test1")
+        cls.profile = Profile.objects.create(user=cls.user, course=cls.course)
+        cls.profile_lesson = ProfileLesson.objects.create(
+            player=cls.profile, lesson_name=cls.lesson.name, lesson_id=cls.lesson.local_id
+        )
+
+    def setUp(self) -> None:
+        # идентификаторы курсов и уроков в тестовой БД переиспользуются
+        invalidate_course_tree(self.course.id)
+        invalidate_lesson_units(self.lesson.id)
+
+    def _open_lesson(self, **params) -> dict:
+        request = RequestFactory().get("/", params)
+        request.profile = self.profile
+        force_authenticate(request, user=self.user)
+
+        response = LessonDetailViewSet.as_view({"get": "retrieve"})(request, local_id=self.lesson.local_id)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def _saved_unit_ids(self) -> list[str]:
+        return list(
+            ProfileLessonChunk.objects.filter(lesson=self.profile_lesson).order_by("id").values_list("unit_id", flat=True)
+        )
+
+    def test_reopened_lesson_does_not_duplicate_chunks(self) -> None:
+        self._open_lesson()
+        data = self._open_lesson()
+
+        self.assertEqual(self._saved_unit_ids(), ["u_002"])
+        self.assertEqual([chunk.get("unit_id") for chunk in data["chunk"]], ["u_002", None, None])
+
+    def test_reopened_lesson_is_served_with_constant_queries(self) -> None:
+        self._open_lesson()
+
+        # урок, запись урока игрока (дважды) и история чанков одним запросом
+        with self.assertNumQueries(4):
+            self._open_lesson()
+
+    def test_concurrently_saved_chunk_is_skipped_on_insert(self) -> None:
+        def save_concurrently(lesson, chunks):
+            # другой запрос того же игрока успел сохранить сегмент после чтения истории
+            ProfileLessonChunk.objects.create(lesson=self.profile_lesson, type=308, unit_id="u_002")
+            return real_rehydrate_chunks(lesson, chunks)
+
+        with mock.patch("lessons.views.rehydrate_chunks", side_effect=save_concurrently):
+            self._open_lesson()
+
+        self.assertEqual(self._saved_unit_ids(), ["u_002"])
+
+    def test_pointed_chunk_is_saved_and_paid_once(self) -> None:
+        money_amount = self.profile.resources.money_amount
+
+        self._open_lesson(from_unit_id="u_003")
+        self._open_lesson(from_unit_id="u_003")
+
+        saved_unit_ids = self._saved_unit_ids()
+        self.assertEqual(saved_unit_ids[0], "u_003")
+        self.assertEqual(len(saved_unit_ids), len(set(saved_unit_ids)))
+        self.profile.resources.refresh_from_db()
+        self.assertEqual(self.profile.resources.money_amount, money_amount + 10)
+
+    @staticmethod
+    def _history_chunk_ids(data: dict) -> list[int]:
+        # сохраненные чанки отдаются как строки ProfileLessonChunk, новый сегмент - как юниты урока
+        return [chunk["id"] for chunk in data["chunk"] if "lesson_id" in chunk]
+
+    def test_cursor_returns_only_newer_chunks(self) -> None:
+        cursor = self._open_lesson()["last_chunk_id"]
+        self.assertEqual(cursor, ProfileLessonChunk.objects.get(unit_id="u_002").id)
+
+        data = self._open_lesson(from_unit_id="u_003", after_chunk=cursor)
+        history_ids = self._history_chunk_ids(data)
+
+        self.assertTrue(history_ids)
+        self.assertTrue(all(chunk_id > cursor for chunk_id in history_ids))
+        self.assertGreater(data["last_chunk_id"], cursor)
+        self.assertEqual(data["last_chunk_id"], max(ProfileLessonChunk.objects.values_list("id", flat=True)))
+
+        next_data = self._open_lesson(from_unit_id="u_003", after_chunk=data["last_chunk_id"])
+
+        self.assertEqual(self._history_chunk_ids(next_data), [])
+        self.assertEqual(next_data["last_chunk_id"], data["last_chunk_id"])
+
+    def test_invalid_or_missing_cursor_returns_full_history(self) -> None:
+        self._open_lesson()
+        self._open_lesson(from_unit_id="u_003")
+        saved_chunk_ids = list(ProfileLessonChunk.objects.order_by("id").values_list("id", flat=True))
+
+        for params in ({}, {"after_chunk": "abc"}, {"after_chunk": ""}):
+            with self.subTest(params=params):
+                data = self._open_lesson(from_unit_id="u_003", **params)
+                self.assertEqual(self._history_chunk_ids(data), saved_chunk_ids)
+                self.assertEqual(data["last_chunk_id"], saved_chunk_ids[-1])
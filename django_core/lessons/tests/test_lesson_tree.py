@@ -0,0 +1,224 @@
+from django.core.cache import cache
+from django.test import TestCase
+
+from lessons.models import Lesson, LessonBlock, Course, Unit, LessonUnitsSnapshot
+from lessons.serializers import UnitDetailSerializer
+from lessons.structures import LessonBlockType
+from lessons.structures.tasks import SortBlock
+from helpers import lesson_tree
+from helpers.lesson_tree import get_lesson_units_tree, invalidate_lesson_units, rebuild_lesson_units, rehydrate_chunks
+from helpers.testing import OnCommitCallbacksMixin
+
+
+class LessonUnitsTreeTestCase(OnCommitCallbacksMixin, TestCase):
+    """
+        Урок: u_001 (реплика) -> u_002 (задание на сортировку)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = Course.objects.create(name="test", description="test")
+        cls.lesson = Lesson.objects.create(
+            course=cls.course, local_id="l_001", name="l_001_name", description="fixture",
+            time_cost=0, money_cost=0, energy_cost=0,
+            content=LessonBlock.objects.create(entry="u_001")
+        )
+
+        cls.options = [{"id": option_id} for option_id in ("a", "b", "c")]
+        sort_task = SortBlock.objects.create(
+            title="sort", description="fixture", if_correct="", if_incorrect="",
+            options=cls.options, correct=["a", "b", "c"]
+        )
+
+        Unit.objects.create(
+            lesson=cls.lesson, lesson_block=cls.lesson.content, local_id="u_001",
+            type=LessonBlockType.replica.value, content={"message": "u_001"}, next=["u_002"]
+        )
+        Unit.objects.create(
+            lesson=cls.lesson, lesson_block=cls.lesson.content, local_id="u_002",
+            type=LessonBlockType.sort.value, next=[],
+            content={"id": sort_task.id, "options": cls.options, "correct": ["a", "b", "c"]}
+        )
+
+    def setUp(self) -> None:
+        # идентификаторы уроков в тестовой БД переиспользуются
+        invalidate_lesson_units(self.lesson.id)
+
+    def test_lesson_tree_is_compiled_once(self) -> None:
+        unit_tree = get_lesson_units_tree(self.lesson)
+
+        with self.assertNumQueries(0):
+            self.assertIs(get_lesson_units_tree(self.lesson), unit_tree)
+            self.assertEqual(unit_tree.task_count, 1)
+            self.assertEqual(len(unit_tree.make_lessons_queue()[2]), 2)
+
+    def test_lesson_tree_is_restored_from_shared_cache(self) -> None:
+        unit_tree = get_lesson_units_tree(self.lesson)
+        lesson_tree._compiled_lessons.clear()
+
+        with self.assertNumQueries(0):
+            restored_tree = get_lesson_units_tree(self.lesson)
+
+        self.assertIsNot(restored_tree, unit_tree)
+        self.assertEqual(restored_tree.get_hash(), unit_tree.get_hash())
+
+    def test_lesson_tree_is_rebuilt_after_unit_change(self) -> None:
+        unit_tree = get_lesson_units_tree(self.lesson)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Unit.objects.filter(local_id="u_002").first().save()
+
+        self.assertIsNot(get_lesson_units_tree(self.lesson), unit_tree)
+
+    def test_chunk_tasks_are_shuffled_without_queries(self) -> None:
+        unit_tree = get_lesson_units_tree(self.lesson)
+
+        with self.assertNumQueries(0):
+            for _ in range(5):
+                task_data = unit_tree.make_lessons_queue()[2][-1]
+
+                self.assertNotIn("correct", task_data["content"])
+                self.assertNotEqual(task_data["content"]["options"], self.options)
+                self.assertCountEqual(task_data["content"]["options"], self.options)
+
+        # подготовленный чанк не меняется от перемешивания
+        self.assertEqual(unit_tree.chunks[None].queue[-1]["content"]["options"], self.options)
+
+    def test_branching_variants_are_shuffled_per_request(self) -> None:
+        lesson = Lesson.objects.create(
+            course=self.course, local_id="l_002", name="l_002_name", description="fixture",
+            time_cost=0, money_cost=0, energy_cost=0,
+            content=LessonBlock.objects.create(entry="u_101")
+        )
+        sort_task = SortBlock.objects.get()
+
+        Unit.objects.create(
+            lesson=lesson, lesson_block=lesson.content, local_id="u_101",
+            type=LessonBlockType.replica.value, content={"message": "u_101"}, next=["u_102", "u_103"]
+        )
+        Unit.objects.create(
+            lesson=lesson, lesson_block=lesson.content, local_id="u_102",
+            type=LessonBlockType.sort.value, next=[],
+            content={"id": sort_task.id, "options": self.options, "correct": ["a", "b", "c"]}
+        )
+        Unit.objects.create(
+            lesson=lesson, lesson_block=lesson.content, local_id="u_103",
+            type=LessonBlockType.replica.value, content={"message": "u_103"}, next=[]
+        )
+        invalidate_lesson_units(lesson.id)
+        unit_tree = get_lesson_units_tree(lesson)
+
+        def get_task_variant(seed: int) -> dict:
+            a18_data = unit_tree.make_lessons_queue(seed=seed)[2][-1]
+            self.assertEqual(a18_data["type"], 218)
+
+            return next(variant for variant in a18_data["content"]["variants"] if variant["id"] == "u_102")
+
+        with self.assertNumQueries(0):
+            task_variant = get_task_variant(seed=42)
+
+        self.assertNotIn("correct", task_variant["content"])
+        self.assertNotEqual(task_variant["content"]["options"], self.options)
+        self.assertCountEqual(task_variant["content"]["options"], self.options)
+        self.assertEqual(get_task_variant(seed=42), task_variant)
+
+    def test_resumed_lesson_is_served_from_cache(self) -> None:
+        lesson_tree._compiled_lessons.clear()
+        get_lesson_units_tree(self.lesson)
+
+        with self.assertNumQueries(0):
+            _, _, queue = get_lesson_units_tree(self.lesson).make_lessons_queue("u_001")
+
+        self.assertEqual([unit_data["id"] for unit_data in queue], ["u_002"])
+        self.assertEqual(lesson_tree._compiled_lessons.stats, {"size": 1, "hits": 1, "misses": 1})
+
+    def test_task_units_are_serialized_with_one_query_per_type(self) -> None:
+        task_unit = Unit.objects.get(local_id="u_002")
+        units = [task_unit] * 3
+
+        with self.assertNumQueries(1):
+            units_data = UnitDetailSerializer(units, many=True).data
+
+        self.assertTrue(all("correct" not in unit_data["content"] for unit_data in units_data))
+
+    def test_chunk_is_stored_by_reference_and_rehydrated(self) -> None:
+        unit_tree = get_lesson_units_tree(self.lesson)
+        task_data = unit_tree.make_lessons_queue(seed=42)[2][-1]
+
+        storage = unit_tree.get_chunk_storage(task_data, seed=42)
+        self.assertEqual(storage, {"content_version": unit_tree.version, "delta": {"seed": 42}})
+
+        storage["delta"]["answer"] = ["c", "b", "a"]
+        saved_chunk = {"id": 1, "lesson_id": 1, "type": task_data["type"], "unit_id": "u_002", "content": {}, **storage}
+
+        with self.assertNumQueries(0):
+            [rehydrated_chunk] = rehydrate_chunks(self.lesson, [saved_chunk])
+
+        self.assertEqual(rehydrated_chunk["content"], {**task_data, "answer": ["c", "b", "a"]})
+        self.assertNotIn("delta", rehydrated_chunk)
+
+    def test_expired_version_is_restored_from_snapshot(self) -> None:
+        unit_tree = get_lesson_units_tree(self.lesson)
+        task_data = unit_tree.make_lessons_queue(seed=42)[2][-1]
+        task_storage = unit_tree.get_chunk_storage(task_data, seed=42)
+        task_storage["delta"]["answer"] = ["c", "b", "a"]
+        pointed_storage = unit_tree.get_pointed_chunk_storage(unit_tree.m_units["u_001"])
+        saved_chunks = [
+            {"id": 1, "lesson_id": 1, "type": task_data["type"], "unit_id": "u_002", "content": {}, **task_storage},
+            {"id": 2, "lesson_id": 1, "type": 100, "unit_id": "u_001", "content": {}, **pointed_storage},
+        ]
+        history = rehydrate_chunks(self.lesson, saved_chunks)
+
+        # юнит задания удален из урока, а прошлая версия вытеснена из кэшей
+        with self.captureOnCommitCallbacks(execute=True):
+            Unit.objects.filter(local_id="u_001").update(next=[])
+            Unit.objects.get(local_id="u_002").delete()
+
+        cache.clear()
+        lesson_tree._compiled_lessons.clear()
+
+        with self.assertNumQueries(1):
+            restored_history = rehydrate_chunks(self.lesson, saved_chunks)
+
+        self.assertEqual(LessonUnitsSnapshot.objects.filter(lesson=self.lesson).count(), 1)
+        self.assertEqual(restored_history, history)
+        self.assertEqual(restored_history[0]["content"]["answer"], ["c", "b", "a"])
+        self.assertEqual(restored_history[1]["content"]["content"], {"message": "u_001"})
+
+    def test_version_without_snapshot_is_not_replaced_silently(self) -> None:
+        saved_chunk = {
+            "id": 1, "lesson_id": 1, "type": 100, "unit_id": "u_001", "content": {},
+            "content_version": "unknown", "delta": {"pointed": True},
+        }
+
+        with self.assertLogs("helpers.lesson_tree", "WARNING"):
+            [rehydrated_chunk] = rehydrate_chunks(self.lesson, [saved_chunk])
+
+        self.assertEqual(rehydrated_chunk["unit_id"], "u_001")
+
+    def test_lesson_aggregates_are_stored_on_rebuild(self) -> None:
+        Unit.objects.create(
+            lesson=self.lesson, lesson_block=self.lesson.content, local_id="u_003",
+            type=LessonBlockType.a17_days.value, content={"value": 2}, next=[]
+        )
+
+        # сборка урока при чтении ничего не пишет: юниты и задания
+        with self.assertNumQueries(2):
+            get_lesson_units_tree(self.lesson)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            rebuild_lesson_units(self.lesson.id)
+
+        self.lesson.refresh_from_db()
+
+        self.assertEqual(self.lesson.unit_count, 3)
+        self.assertEqual(self.lesson.next_days_count, 2)
+
+    def test_task_is_taken_from_compiled_lesson(self) -> None:
+        get_lesson_units_tree(self.lesson)
+
+        with self.assertNumQueries(0):
+            task = get_lesson_units_tree(self.lesson).get_task("u_002")
+
+        self.assertIsInstance(task, SortBlock)
+        self.assertTrue(task.check_answer(["a", "b", "c"]))
@@ -0,0 +1,40 @@
+from django.test import SimpleTestCase
+
+from lessons.structures.tasks import CheckboxesBlock, InputBlock, NumberBlock, RadiosTableBlock, ComparisonBlock
+
+
+class TaskCheckersTestCase(SimpleTestCase):
+    def test_checkboxes_answer_is_compared_as_multiset(self) -> None:
+        task = CheckboxesBlock(variants=[{"id": "a"}, {"id": "b"}, {"id": "c"}], correct=["a", "b"])
+
+        self.assertTrue(task.check_answer(["b", "a"]))
+        self.assertFalse(task.check_answer(["a", "a"]))
+        self.assertFalse(task.check_answer(["a", "b", "c"]))
+        self.assertEqual(task.get_details(["a", "d"]), {"a": False, "d": False})
+
+    def test_input_answer_is_checked_against_normalized_set(self) -> None:
+        task = InputBlock(correct={"ru": ["Ответ"], "en": ["Answer"]})
+
+        self.assertTrue(task.check_answer("ОТВЕТ"))
+        self.assertTrue(task.check_answer("answer"))
+        self.assertFalse(task.check_answer("другой"))
+
+    def test_number_answer_is_checked_against_bounds(self) -> None:
+        task = NumberBlock(correct=10.0, tolerance=0.1)
+
+        self.assertEqual(task.bounds, (9.0, 11.0))
+        self.assertTrue(task.check_answer(10.5))
+        self.assertFalse(task.check_answer(11.5))
+
+    def test_radios_table_rows_are_compared_without_sorting(self) -> None:
+        task = RadiosTableBlock(columns=[], rows=[], is_radio=False, correct={"r1": ["a", "b"], "r2": ["c"]})
+
+        self.assertTrue(task.check_answer({"r1": ["b", "a"], "r2": ["c"]}))
+        self.assertFalse(task.check_answer({"r1": ["a"], "r2": ["c"]}))
+        self.assertEqual(task.get_details({"r1": ["a", "c"]}), {"r1": {"a": True, "c": False}})
+
+    def test_comparison_pairs_are_prepared_once(self) -> None:
+        task = ComparisonBlock(lists=[], correct=[["a", "1"], ["b", "2"]])
+
+        self.assertEqual(task.get_details([["1", "a"], ["b", "1"]]), [0])
+        self.assertIs(task.correct_pairs, task.correct_pairs)
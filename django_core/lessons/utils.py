@@ -1,8 +1,9 @@
 from accounts.models import Profile
 from accounts.serializers import ProfileSerializer
-from helpers.course_tree import CourseLessonsTree
+from helpers.course_tree import get_course_tree, CourseProgressSnapshot
 from lessons.models import UnitAffect, Lesson, Branching
-from resources.utils import get_max_energy_by_position
+from resources.models import ResourcesEventReason
+from resources.utils import get_max_energy_by_position, change_resources
 from student_tasks.models import StudentTaskAnswer
 
 
@@ -17,23 +18,29 @@ def process_affect(affect: UnitAffect, profile: Profile) -> None:
         serializer.save()
 
         if affect.code == UnitAffect.UnitCodeType.JOB_CHOICE:
-            profile.resources.set_energy(get_max_energy_by_position(profile.university_position))
-            profile.resources.save()
+            change_resources(
+                profile.id, ResourcesEventReason.POSITION,
+                min_energy=get_max_energy_by_position(profile.university_position)
+            )
 
 
-def check_entity_is_accessible(profile: Profile, entity: Lesson | Branching) -> bool:
+def check_entity_is_accessible(
+    profile: Profile,
+    entity: Lesson | Branching,
+    snapshot: CourseProgressSnapshot = None,
+) -> bool:
     if profile.user.is_superuser:
         return True
 
-    course_tree = CourseLessonsTree(entity.course)
-    course_map = [block.local_id for block in course_tree.get_map_for_profile(profile)]
+    if snapshot is None:
+        snapshot = get_course_tree(entity.course_id).get_progress_snapshot(profile)
 
-    if entity.local_id not in course_map:
-        return False
+    position = snapshot.positions.get(entity.local_id)
 
-    active_id = course_tree.get_active(profile)
+    if position is None:
+        return False
 
-    return course_map.index(entity.local_id) <= active_id
+    return position <= snapshot.active
 
 
 def check_all_tasks_are_done(profile: Profile, lesson: Lesson) -> bool:
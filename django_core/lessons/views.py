@@ -1,3 +1,5 @@
+import random
+
 from rest_framework import (
     viewsets,
     permissions,
@@ -9,7 +11,7 @@ from rest_framework import (
     generics
 )
 from django.shortcuts import get_object_or_404
-from django.db.models import Prefetch
+from django.db.models import Prefetch, Max
 from django.forms.models import model_to_dict
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.request import Request
@@ -23,7 +25,6 @@ from accounts.serializers import (
     GetCourselistSerializer,
     ProfileSerializerWithoutLookForms,
 )
-from resources.models import Resources
 from lessons.models import (
     NPC,
     Location,
@@ -68,15 +69,15 @@ from lessons.exceptions import (
     NotAllTasksDoneException,
     CanNotSkipLessonException
 )
-from helpers.lesson_tree import LessonUnitsTree
-from helpers.course_tree import CourseLessonsTree
+from helpers.lesson_tree import get_lesson_units_tree, rehydrate_chunks
+from helpers.course_tree import get_course_tree, ProfileCourseProgress, mark_lesson_done
 from helpers.swagger_factory import SwaggerFactory
 from resources.exceptions import (
     NotEnoughEnergyException,
     NotEnoughMoneyException
 )
-from resources.models import EmotionData
-from resources.utils import check_ultimate_is_active
+from resources.models import EmotionData, ResourcesEventReason
+from resources.utils import check_ultimate_is_active, change_resources, refill_energy
 from student_tasks.models import StudentTaskAnswer
 from student_tasks.serializers import StudentTaskAnswerSerializer
 
@@ -97,10 +98,7 @@ class LocationViewSet(viewsets.ReadOnlyModelViewSet):
 
 
 class CourseMapViewSet(viewsets.GenericViewSet, mixins.RetrieveModelMixin):
-    queryset = Course.objects.prefetch_related(
-        "lessons", "quests", "branchings",
-        "quests__lessons", "quests__branchings",
-    )
+    queryset = Course.objects.all()
     serializer_class = CourseMapSerializer
     permission_classes = (permissions.IsAuthenticated,)
 
@@ -129,18 +127,19 @@ class BranchSelectViewSet(viewsets.GenericViewSet, mixins.RetrieveModelMixin, mi
     ))
     def retrieve(self, request: Request, *args: tuple, **kwargs: dict) -> Response:
         branching = self.get_object()
-        profile: Profile = request.user.profile.get(course_id=1)
+        profile: Profile = request.profile
+        progress = ProfileCourseProgress(profile)
+        snapshot = get_course_tree(branching.course_id).get_progress_snapshot(profile, progress)
 
-        if not check_entity_is_accessible(profile, branching):
+        if not check_entity_is_accessible(profile, branching, snapshot):
             raise BlockEntityIsUnavailableException("Finish previous lessons to select branching")
 
-        if ProfileBranchingChoice.objects.filter(
-                branching=branching,
-                profile=self.request.user.profile.get(course=1)
-        ).exists():
+        if branching.id in progress.branching_choices:
             raise BranchingAlreadyChosenException()
 
-        return super().retrieve(request, *args, **kwargs)
+        serializer = self.get_serializer(branching)
+        serializer.context["progress"] = progress
+        return Response(serializer.data)
 
     @swagger_auto_schema(**SwaggerFactory()(
         responses=[
@@ -178,7 +177,17 @@ class LessonDetailViewSet(
                 or not settings.CHECK_ENERGY_ON_LESSON_ENTER
         ):
             return True
-        return profile.resources.energy_amount >= lesson.energy_cost
+        return refill_energy(profile.resources).energy_amount >= lesson.energy_cost
+
+    @staticmethod
+    def _chunk_to_values(profile_lesson_chunk: ProfileLessonChunk) -> dict:
+        """
+            Чанк в том же виде, в котором его возвращает QuerySet.values()
+        """
+        return {
+            field.attname: field.value_from_object(profile_lesson_chunk)
+            for field in ProfileLessonChunk._meta.concrete_fields
+        }
 
     @swagger_auto_schema(**SwaggerFactory()(
         responses=[
@@ -189,23 +198,30 @@ class LessonDetailViewSet(
     def retrieve(self, request: Request, *args: tuple, **kwargs: dict) -> Response:
         lesson = self.get_object()
         from_unit_id = request.GET.get("from_unit_id", None)
+        after_chunk = request.GET.get("after_chunk", "")
+        after_chunk = int(after_chunk) if after_chunk.isdigit() else None
 
-        profile: Profile = request.user.profile.get(course=1)
+        profile: Profile = request.profile
         player = ProfileSerializerWithoutLookForms(profile, context={"request": request})
 
-        if not check_entity_is_accessible(profile, lesson):
+        course_tree = get_course_tree(lesson.course_id)
+        progress = ProfileCourseProgress(profile)
+        snapshot = course_tree.get_progress_snapshot(profile, progress)
+
+        if not check_entity_is_accessible(profile, lesson, snapshot):
             raise BlockEntityIsUnavailableException("Finish previous lessons to view this lesson")
 
-        is_already_finished = ProfileLessonDone.objects.filter(profile=profile, lesson=lesson).exists()
+        is_already_finished = lesson.local_id in snapshot.interacted
 
         if not is_already_finished and not self._check_is_enough_energy(profile, lesson):
             raise NotEnoughEnergyException("Not enough energy to enter lesson")
 
-        unit_tree = LessonUnitsTree(lesson)
-        course_tree = CourseLessonsTree(lesson.course)
+        unit_tree = get_lesson_units_tree(lesson)
+        # по seed перемешивание заданий восстанавливается при чтении сохраненных чанков
+        seed = random.getrandbits(32)
 
         first_location_id, first_npc_id, unit_chunk = (
-            unit_tree.make_lessons_queue(from_unit_id, hide_task_answers=True)
+            unit_tree.make_lessons_queue(from_unit_id, seed=seed)
         )
 
         lesson_data = {}
@@ -224,14 +240,14 @@ class LessonDetailViewSet(
             locales["en"][lesson_name_field] = lesson.course.locale["en"][lesson_name_field]
 
             lesson_data.update({
-                "finished": ProfileLessonDone.objects.filter(lesson=lesson, profile=profile).exists(),
+                "finished": is_already_finished,
                 "skipped" : ProfileLesson.objects.filter(player=profile, lesson_name=lesson.name).first().skipped,
                 "location": first_location_id or 1,
                 "npc": first_npc_id or -1,
                 "locales": locales,
                 "tasks": unit_tree.task_count,
-                "quest_number": course_tree.get_quest_number(profile, lesson),
-                "lesson_number": course_tree.get_lesson_number(profile, lesson) - 1,
+                "quest_number": course_tree.get_quest_number(profile, lesson, progress),
+                "lesson_number": course_tree.get_lesson_number(profile, lesson, progress) - 1,
             })
 
         ##########################
@@ -243,36 +259,59 @@ class LessonDetailViewSet(
                                                           location=first_location_id or 1,
                                                           npc=first_npc_id or -1, lesson_id=lesson.local_id)
 
-        if from_unit_id and ProfileLessonChunk.objects.filter(unit_id=from_unit_id,
-                                                              lesson=profile_lesson).first() is None:
-            unit = Unit.objects.get(local_id=from_unit_id)
-            ProfileLessonChunk.objects.create(lesson=profile_lesson, content=model_to_dict(unit), unit_id=from_unit_id,
-                                              type=unit.type)
-
-            # increase/decrease money and energy
-
-            resource = Resources.objects.get(user=profile)
-
-            money = unit.content.get("money", 0)
-            energy = unit.content.get("energy", 0)
-
-            resource.money_amount += int(money)
-
-            resource.energy_amount += int(energy)
-
-            resource.save()
-        saved_chunks = list(ProfileLessonChunk.objects.filter(lesson=profile_lesson).values())
-        chunk = [*saved_chunks, *unit_chunk]
-
-
-        for unit in unit_chunk:
-            if unit['type'] != 218 and ProfileLessonChunk.objects.filter(unit_id=unit['id']).first() is None:
-                ProfileLessonChunk.objects.create(lesson=profile_lesson, content=unit, type=unit['type'],
-                                                  unit_id=unit['id'])
-
-                ###############################
-
-        data = {**lesson_data, "player": player.data, "chunk": chunk}
+        profile_lesson_chunks = ProfileLessonChunk.objects.filter(lesson=profile_lesson).order_by("id")
+
+        if after_chunk is None:
+            # чанки урока только дописываются, поэтому один запрос отдает и историю, и уже сохраненные юниты
+            saved_chunks = list(profile_lesson_chunks.values())
+            saved_unit_ids = {saved_chunk["unit_id"] for saved_chunk in saved_chunks}
+        else:
+            # клиент уже получил чанки до курсора, отдаем только более новые
+            saved_chunks = list(profile_lesson_chunks.filter(id__gt=after_chunk).values())
+            unit_ids = [unit['id'] for unit in unit_chunk if unit['type'] != 218]
+            if from_unit_id:
+                unit_ids.append(from_unit_id)
+
+            saved_unit_ids = set(
+                profile_lesson_chunks.filter(unit_id__in=unit_ids).values_list("unit_id", flat=True)
+            )
+
+        if from_unit_id and from_unit_id not in saved_unit_ids:
+            unit = unit_tree.m_units.get(from_unit_id) or Unit.objects.get(local_id=from_unit_id)
+            pointed_chunk, created = ProfileLessonChunk.objects.get_or_create(
+                lesson=profile_lesson, unit_id=from_unit_id,
+                defaults={"type": unit.type, **unit_tree.get_pointed_chunk_storage(unit)},
+            )
+            saved_chunks.append(self._chunk_to_values(pointed_chunk))
+            saved_unit_ids.add(from_unit_id)
+
+            if created:
+                # increase/decrease money and energy
+                change_resources(
+                    profile.id, ResourcesEventReason.UNIT,
+                    money=int(unit.content.get("money", 0)),
+                    energy=int(unit.content.get("energy", 0)),
+                )
+
+        chunk = [*rehydrate_chunks(lesson, saved_chunks), *unit_chunk]
+
+        new_chunks = ProfileLessonChunk.objects.bulk_create([
+            ProfileLessonChunk(
+                lesson=profile_lesson, type=unit['type'], unit_id=unit['id'],
+                **unit_tree.get_chunk_storage(unit, seed)
+            )
+            for unit in unit_chunk
+            if unit['type'] != 218 and unit['id'] not in saved_unit_ids
+        ], ignore_conflicts=True)
+
+        # курсор для следующего запроса: новый сегмент клиент уже получил в chunk
+        last_chunk_id = max([after_chunk or 0, *(saved_chunk["id"] for saved_chunk in saved_chunks)])
+        if new_chunks:
+            last_chunk_id = profile_lesson_chunks.aggregate(last_chunk_id=Max("id"))["last_chunk_id"]
+
+        ###############################
+
+        data = {**lesson_data, "player": player.data, "chunk": chunk, "last_chunk_id": last_chunk_id}
 
         return Response(data, status=status.HTTP_200_OK)
 
@@ -296,7 +335,7 @@ class QuestionViewSet(viewsets.GenericViewSet, mixins.CreateModelMixin):
 
 
 class LessonActionsViewSet(viewsets.GenericViewSet):
-    queryset = Lesson.objects.select_related("course", "quest").prefetch_related("unit_set")
+    queryset = Lesson.objects.select_related("course", "quest")
     serializer_class = LessonFinishSerializer
     permission_classes = (permissions.IsAuthenticated,)
     lookup_field = "local_id"
@@ -307,21 +346,19 @@ class LessonActionsViewSet(viewsets.GenericViewSet):
         return s_bonuses.get("energy", 0), s_bonuses.get("money", 0)
 
     def _calculate_resources(self, profile: Profile, lesson: Lesson, salary: int = 0) -> None:
-        resources = profile.resources
+        energy_cost = 0
 
         if settings.CHECK_ENERGY_ON_LESSON_ENTER and not check_ultimate_is_active(profile):
-            resources.energy_amount -= lesson.energy_cost
+            energy_cost = lesson.energy_cost
 
         s_energy, s_money = self._get_scientific_bonuses(profile, lesson)
-        next_days_count = sum(list(map(
-            lambda x: x.content.get("value", 0),
-            Unit.objects.filter(lesson=lesson, type=217)
-        )))
 
-        resources.energy_amount += s_energy
-        resources.money_amount += salary + s_money
-        resources.time_amount += lesson.time_cost + next_days_count
-        resources.save()
+        change_resources(
+            profile.id, ResourcesEventReason.LESSON_FINISH,
+            time=lesson.time_cost + lesson.next_days_count,
+            money=salary + s_money,
+            energy=s_energy - energy_cost,
+        )
 
     def _calculate_statistic(self, profile: Profile, lesson: Lesson, duration: int) -> None:
         statistics = profile.statistics
@@ -348,22 +385,28 @@ class LessonActionsViewSet(viewsets.GenericViewSet):
     @decorators.action(methods=["POST"], detail=True, url_path="finish")
     def finish_lesson(self, request: Request, *args: tuple, **kwargs: dict) -> Response:
         lesson: Lesson = self.get_object()
-        profile: Profile = request.user.profile.get(course_id=1)
+        profile: Profile = request.profile
+        progress = ProfileCourseProgress(profile)
+        snapshot = get_course_tree(lesson.course_id).get_progress_snapshot(profile, progress)
 
-        if not check_entity_is_accessible(profile, lesson):
+        if not check_entity_is_accessible(profile, lesson, snapshot):
             raise BlockEntityIsUnavailableException("Finish previous lessons to get access")
         if not check_all_tasks_are_done(profile, lesson):
             raise NotAllTasksDoneException()
 
-        lesson_tree = LessonUnitsTree(lesson)
+        lesson_tree = get_lesson_units_tree(lesson)
         if request.data.get("lesson_key", "0") != lesson_tree.get_hash():
             raise LessonForbiddenException()
 
-        lesson_finish_data = self.serializer_class(lesson, context={"profile": profile}).data
-        if ProfileLessonDone.objects.filter(lesson=lesson, profile=profile).exists():
+        lesson_finish_data = self.serializer_class(lesson, context={"profile": profile, "progress": progress}).data
+        if lesson.id in progress.done_lessons:
             return Response(lesson_finish_data, status=status.HTTP_200_OK)
 
         with transaction.atomic():
+            # профиль блокируется: параллельное завершение того же урока ничего не начислит повторно
+            if not mark_lesson_done(profile, lesson.id):
+                return Response(lesson_finish_data, status=status.HTTP_200_OK)
+
             self._calculate_resources(profile, lesson, salary=lesson_finish_data["salary_amount"])
             self._calculate_statistic(profile, lesson, duration=int(request.data.get("duration", 0)))
             self._create_emotion(profile, lesson, emotion=request.data.get("emotion", {"emotion": 0, "comment": ""}))
@@ -377,7 +420,7 @@ class LessonActionsViewSet(viewsets.GenericViewSet):
     @decorators.action(methods=["GET"], detail=False, url_path="lesson/(?P<local_id>[^/.]+)/skip")
     def skip_lesson(self, request: Request, *args: tuple, **kwargs: dict) -> Response:
         lesson: Lesson = self.get_object()
-        profile: Profile = request.user.profile.get()
+        profile: Profile = request.profile
         resources = profile.resources
         if not resources.can_skip_lesson:
             raise CanNotSkipLessonException()
@@ -400,7 +443,7 @@ class CallbackAPIView(views.APIView):
             raise UnitNotFoundException(f"Unit with id: {block.local_id} not found")
 
         affect = block.profile_affect
-        process_affect(affect, request.user.profile.get(course_id=1))
+        process_affect(affect, request.profile)
 
         return Response({"status": "ok"}, status=status.HTTP_200_OK)
 
@@ -415,10 +458,23 @@ class NewCourseMapViewSet(
         Prefetch('lessons', queryset=Lesson.objects.order_by('id')),
         Prefetch('quests', queryset=Quest.objects.order_by('id')),
         Prefetch('branchings', queryset=Branching.objects.order_by('id')),
-        "lessons__unit_set", "quests__lessons", "quests__branchings",
+        "quests__lessons", "quests__branchings",
     )
     serializer_class = NewCourseMapSerializer
 
+    def get_serializer_context(self) -> dict:
+        """
+            Прогресс игрока загружается один раз на запрос, сериализаторы уроков и развилок только читают его
+        """
+        context = super().get_serializer_context()
+        profile = self.request.profile
+
+        context["done_lessons"] = ProfileCourseProgress(profile).done_lessons
+        context["branching_choices"] = dict(
+            ProfileBranchingChoice.objects.filter(profile=profile).values_list("branching_id", "choose_local_id")
+        )
+        return context
+
 
 class ProfileLessonAPIView(views.APIView):
     @swagger_auto_schema(
@@ -426,9 +482,11 @@ class ProfileLessonAPIView(views.APIView):
     )
     def get(self, request, pk):
         try:
-            profile = request.user.profile.get()
+            profile = request.profile
             lesson = ProfileLesson.objects.filter(player=profile, lesson_id=pk).first()
-            serializer = SavedProfileLessonSerializer(lesson)
+            serializer = SavedProfileLessonSerializer(lesson, context={
+                "lesson": Lesson.objects.select_related("content").filter(local_id=pk).first(),
+            })
             return Response(serializer.data)
         except ProfileLesson.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
@@ -444,7 +502,7 @@ class ValidateSkipTaskAPIView(views.APIView):
         except ProfileLesson.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
 
-        profile = request.user.profile.get()
+        profile = request.profile
         undone_tasks = StudentTaskAnswer.objects.filter(profile=profile, task__lesson=lesson, is_correct=False).count()
         if undone_tasks >= 3:
             return Response(status=status.HTTP_400_BAD_REQUEST)
@@ -459,7 +517,7 @@ class FirstSkippedTaskAPIView(views.APIView):
         except ProfileLesson.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
 
-        profile = request.user.profile.get()
+        profile = request.profile
         first_undone_task = StudentTaskAnswer.objects.filter(profile=profile, task__lesson=lesson,
                                                              is_correct=False).first()
 
@@ -0,0 +1,33 @@
+# Generated by Django 3.1.7 on 2026-10-17 15:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0035_auto_20240407_1733'),
+        ('resources', '0008_resources_can_skip_lesson'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResourcesEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reason', models.CharField(choices=[('unit', 'Unit'), ('lesson_finish', 'Lesson Finish'), ('ultimate', 'Ultimate'), ('manual', 'Manual'), ('compacted', 'Compacted')], max_length=15)),
+                ('time_delta', models.IntegerField(default=0)),
+                ('money_delta', models.IntegerField(default=0)),
+                ('energy_delta', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='resources_events', to='accounts.profile')),
+            ],
+            options={
+                'verbose_name': 'ResourcesEvent',
+                'verbose_name_plural': 'ResourcesEvents',
+                'ordering': ('created_at',),
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.1.7 on 2026-10-17 15:05
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('resources', '0009_resourcesevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resources',
+            name='energy_refilled_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.7 on 2026-10-17 15:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('resources', '0011_resourcesevent_branching_reason'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='resourcesevent',
+            name='reason',
+            field=models.CharField(choices=[('unit', 'Unit'), ('lesson_finish', 'Lesson Finish'), ('ultimate', 'Ultimate'), ('branching', 'Branching'), ('energy_refill', 'Energy Refill'), ('position', 'Position'), ('director', 'Scientific Director'), ('manual', 'Manual'), ('compacted', 'Compacted')], max_length=15),
+        ),
+    ]
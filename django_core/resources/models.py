@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 
 class EmotionData(models.Model):
@@ -31,6 +32,7 @@ class Resources(models.Model):
     time_amount = models.PositiveIntegerField(default=0)
     money_amount = models.PositiveIntegerField(default=0)
     energy_amount = models.PositiveIntegerField(default=0)
+    energy_refilled_at = models.DateTimeField(default=timezone.now)
     can_skip_lesson = models.BooleanField(default=True)
 
     class Meta:
@@ -38,11 +40,45 @@ class Resources(models.Model):
         verbose_name = "Resources"
         verbose_name_plural = "Resources"
 
-    def set_energy(self, energy_amount: int) -> None:
-        self.energy_amount = max(self.energy_amount, energy_amount)
-
     def __repr__(self) -> str:
         return f"{self._meta.verbose_name} - {self.user.username}"
 
     def __str__(self) -> str:
         return repr(self)
+
+
+class ResourcesEventReason(models.TextChoices):
+    UNIT = "unit"
+    LESSON_FINISH = "lesson_finish"
+    ULTIMATE = "ultimate"
+    BRANCHING = "branching"
+    ENERGY_REFILL = "energy_refill"
+    POSITION = "position"
+    SCIENTIFIC_DIRECTOR = "director"
+    MANUAL = "manual"
+    COMPACTED = "compacted"
+
+
+class ResourcesEvent(models.Model):
+    """
+        Таблица БД для журнала изменений ресурсов персонажа (профиля).
+        Хранит примененные изменения, старые события периодически схлопываются
+    """
+    profile = models.ForeignKey("accounts.Profile", on_delete=models.CASCADE, related_name="resources_events")
+    reason = models.CharField(max_length=15, choices=ResourcesEventReason.choices)
+    time_delta = models.IntegerField(default=0)
+    money_delta = models.IntegerField(default=0)
+    energy_delta = models.IntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        app_label = "resources"
+        verbose_name = "ResourcesEvent"
+        verbose_name_plural = "ResourcesEvents"
+        ordering = ("created_at",)
+
+    def __repr__(self) -> str:
+        return f"{self._meta.verbose_name} - {self.reason} [{self.profile_id}]"
+
+    def __str__(self) -> str:
+        return repr(self)
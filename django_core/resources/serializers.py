@@ -4,8 +4,8 @@ from rest_framework import serializers
 from django.conf import settings
 
 from resources.exceptions import NegativeResourcesException, EnergyOverfillException
-from resources.models import Resources, EmotionData
-from resources.utils import get_max_energy_by_position
+from resources.models import Resources, EmotionData, ResourcesEventReason
+from resources.utils import get_max_energy_by_position, change_resources
 
 
 class ResourcesSerializer(serializers.ModelSerializer):
@@ -83,10 +83,20 @@ class ResourcesUpdateSerializer(serializers.Serializer):
         return value
 
     def update(self, instance: Resources, validated_data: dict) -> Resources:
-        instance.time_amount += validated_data["timeDelta"]
-        instance.energy_amount += validated_data["energyDelta"]
-        instance.money_amount += validated_data["moneyDelta"]
-        instance.save()
+        # проверки выше сделаны по прочитанной строке, UPDATE повторяет их атомарно
+        is_changed = change_resources(
+            instance.user_id, ResourcesEventReason.MANUAL,
+            time=validated_data["timeDelta"],
+            money=validated_data["moneyDelta"],
+            energy=validated_data["energyDelta"],
+            max_energy=get_max_energy_by_position(instance.user.university_position),
+            strict=True,
+        )
+
+        if not is_changed:
+            raise NegativeResourcesException()
+
+        instance.refresh_from_db(fields=["time_amount", "money_amount", "energy_amount"])
         return instance
 
 
@@ -1,11 +1,15 @@
 import logging
 
-from django.db.models import QuerySet
+import datetime as dt
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
 
 from django_core.celery import app
-from resources.models import Resources
-from resources.utils import get_max_energy_by_position
-from accounts.models import Profile
+from resources.models import ResourcesEvent, ResourcesEventReason
+from resources.utils import refill_energy_for_all, deactivate_expired_ultimates
 
 logger = logging.getLogger('celery')
 
@@ -13,32 +17,57 @@ logger = logging.getLogger('celery')
 @app.task
 def refill_resources() -> None:
     """
-        Задача для обновления ресурсов в фоне
+        Восполнение энергии всем профилям пачками с записью в журнал ресурсов.
+        В расписание не входит - энергия восполняется лениво при обращении (resources.utils.refill_energy)
     """
-    resources_qs: QuerySet[Resources] = Resources.objects.all()
-    update_list = []
-
-    logger.info('Старт задачи обновления ресурсов')
-    for resource in resources_qs:
-        profile = resource.user
-        logger.info(f'Пользователь: {profile.isu} - {profile.username}')
-        logger.info(f'Должность: {profile.university_position}')
-        logger.info(f'Было энергии: {resource.energy_amount}')
+    logger.info(f'Восполнена энергия профилей: {refill_energy_for_all()}')
 
-        energy = get_max_energy_by_position(profile.university_position)
-        resource.set_energy(energy)
-        logger.info(f'Стало энергии: {resource.energy_amount}')
-        update_list.append(resource)
 
-    Resources.objects.bulk_update(update_list, ["energy_amount"])
+@app.task
+def deactivate_ultimates() -> None:
+    """
+        Периодическая задача, которая сбрасывает флаги истекших ультимейтов.
+        Активность ультимейта определяется по ultimate_finish_datetime, задача только чистит данные
+    """
+    logger.info(f'Отключено ультимейтов: {deactivate_expired_ultimates()}')
 
 
 @app.task
 def deactivate_ultimate(profile_id: int) -> None:
     """
-        Отложенная задача, которая отключает ультимейт
+        Больше не ставится в очередь, оставлена для уже отложенных сообщений
     """
-    profile = Profile.objects.get(id=profile_id)
-    profile.ultimate_activated = False
-    profile.ultimate_finish_datetime = None
-    profile.save()
+    deactivate_expired_ultimates()
+
+
+@app.task
+def compact_resources_events() -> None:
+    """
+        Сворачивает старые события журнала ресурсов в одно событие на профиль
+    """
+    cutoff = timezone.now() - dt.timedelta(days=settings.RESOURCES_EVENTS_COMPACT_AFTER_DAYS)
+    events_qs = ResourcesEvent.objects.filter(created_at__lt=cutoff)
+
+    with transaction.atomic():
+        totals = (
+            events_qs
+            .values("profile_id")
+            .annotate(time=Sum("time_delta"), money=Sum("money_delta"), energy=Sum("energy_delta"))
+            .order_by()
+        )
+        compacted = [
+            ResourcesEvent(
+                profile_id=total["profile_id"],
+                reason=ResourcesEventReason.COMPACTED,
+                time_delta=total["time"],
+                money_delta=total["money"],
+                energy_delta=total["energy"],
+                created_at=cutoff,
+            )
+            for total in totals
+        ]
+
+        deleted, _ = events_qs.delete()
+        ResourcesEvent.objects.bulk_create(compacted)
+
+    logger.info(f'Свернуто событий ресурсов: {deleted} -> {len(compacted)}')
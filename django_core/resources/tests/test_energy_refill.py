@@ -0,0 +1,71 @@
+from datetime import timedelta
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from accounts.models import Profile, UniversityPosition
+from lessons.models import Course
+from resources.models import Resources, ResourcesEventReason
+from resources.utils import (
+    change_resources,
+    get_energy_refill_dt,
+    get_max_energy_by_position,
+    refill_energy,
+    refill_energy_for_all,
+)
+
+
+class EnergyRefillTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = Course.objects.create(name="test", description="test")
+        cls.profile = Profile.objects.create(course=cls.course, university_position=UniversityPosition.INTERN.value)
+        cls.max_energy = get_max_energy_by_position(UniversityPosition.INTERN)
+
+    def setUp(self) -> None:
+        Resources.objects.filter(user=self.profile).update(
+            energy_amount=1, energy_refilled_at=get_energy_refill_dt() - timedelta(hours=1)
+        )
+        self.resources = Resources.objects.select_related("user").get(user=self.profile)
+
+    def test_energy_is_refilled_once_after_midnight(self) -> None:
+        self.assertEqual(refill_energy(self.resources).energy_amount, self.max_energy)
+
+        Resources.objects.filter(id=self.resources.id).update(energy_amount=1)
+        self.resources.refresh_from_db()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(refill_energy(self.resources).energy_amount, 1)
+
+    def test_energy_refill_is_recorded(self) -> None:
+        refill_energy(self.resources)
+
+        event = self.profile.resources_events.get()
+        self.assertEqual(event.reason, ResourcesEventReason.ENERGY_REFILL)
+        self.assertEqual(event.energy_delta, self.max_energy - 1)
+
+    def test_pending_refill_is_applied_on_change(self) -> None:
+        change_resources(self.profile.id, ResourcesEventReason.UNIT, energy=-2)
+
+        self.resources.refresh_from_db()
+        self.assertEqual(self.resources.energy_amount, self.max_energy - 2)
+
+        events = list(self.profile.resources_events.values_list("reason", "energy_delta"))
+        self.assertEqual(events, [
+            (ResourcesEventReason.ENERGY_REFILL, self.max_energy - 1),
+            (ResourcesEventReason.UNIT, -2),
+        ])
+
+    def test_energy_is_refilled_for_all_at_once(self) -> None:
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(refill_energy_for_all(), 1)
+
+        # восполнение пишется в журнал одним INSERT, ресурсы обновляются одним UPDATE
+        self.assertEqual(len([query for query in queries if query["sql"].startswith("INSERT")]), 1)
+        self.assertEqual(len([query for query in queries if query["sql"].startswith("UPDATE")]), 1)
+
+        self.resources.refresh_from_db()
+        self.assertEqual(self.resources.energy_amount, self.max_energy)
+        self.assertEqual(self.profile.resources_events.get().energy_delta, self.max_energy - 1)
+        self.assertEqual(refill_energy_for_all(), 0)
@@ -0,0 +1,95 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Sum
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from accounts.models import Profile, UniversityPosition
+from lessons.models import Course
+from resources.models import ResourcesEventReason
+from resources.tasks import compact_resources_events
+from resources.utils import change_resources, get_max_energy_by_position
+
+
+class ResourcesLedgerTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = Course.objects.create(name="test", description="test")
+        cls.profile = Profile.objects.create(course=cls.course)
+
+    def setUp(self) -> None:
+        self.resources = self.profile.resources
+        self.resources.money_amount = 100
+        self.resources.energy_amount = 5
+        self.resources.save()
+
+    def test_applied_changes_are_recorded(self) -> None:
+        self.assertTrue(change_resources(self.profile.id, ResourcesEventReason.UNIT, money=50, energy=10, max_energy=8))
+
+        self.resources.refresh_from_db()
+        self.assertEqual((self.resources.money_amount, self.resources.energy_amount), (150, 8))
+
+        # в журнал попадает изменение после ограничения max_energy, а не запрошенное
+        event = self.profile.resources_events.get()
+        self.assertEqual((event.money_delta, event.energy_delta), (50, 3))
+
+    def test_change_is_applied_with_one_update_without_locks(self) -> None:
+        with CaptureQueriesContext(connection) as context:
+            change_resources(self.profile.id, ResourcesEventReason.UNIT, money=-30, energy=2)
+
+        queries = [query["sql"] for query in context.captured_queries]
+        self.assertEqual(len([sql for sql in queries if sql.startswith("UPDATE")]), 1)
+        self.assertFalse(any("FOR UPDATE" in sql for sql in queries))
+
+    def test_balances_are_replayed_from_ledger(self) -> None:
+        change_resources(self.profile.id, ResourcesEventReason.UNIT, money=-150, energy=-2)
+        change_resources(self.profile.id, ResourcesEventReason.POSITION, min_energy=10)
+        change_resources(self.profile.id, ResourcesEventReason.LESSON_FINISH, money=30, energy=-20)
+        # изменение, которое ничего не меняет, в журнал не пишется
+        change_resources(self.profile.id, ResourcesEventReason.POSITION, min_energy=0)
+
+        totals = self.profile.resources_events.aggregate(money=Sum("money_delta"), energy=Sum("energy_delta"))
+        self.resources.refresh_from_db()
+
+        self.assertEqual(self.profile.resources_events.count(), 3)
+        self.assertEqual(self.resources.money_amount, 100 + totals["money"])
+        self.assertEqual(self.resources.energy_amount, 5 + totals["energy"])
+
+    def test_position_change_is_recorded(self) -> None:
+        self.profile.university_position = UniversityPosition.INTERN.value
+        self.profile.save()
+
+        event = self.profile.resources_events.get()
+        self.assertEqual(event.reason, ResourcesEventReason.POSITION)
+        self.assertEqual(event.energy_delta, get_max_energy_by_position(UniversityPosition.INTERN) - 5)
+        self.assertEqual(self.profile.resources.energy_amount, get_max_energy_by_position(UniversityPosition.INTERN))
+
+    def test_strict_change_is_rejected_without_writes(self) -> None:
+        self.assertFalse(change_resources(self.profile.id, ResourcesEventReason.ULTIMATE, money=-101, strict=True))
+
+        self.resources.refresh_from_db()
+        self.assertEqual(self.resources.money_amount, 100)
+        self.assertFalse(self.profile.resources_events.exists())
+
+    def test_resources_are_clamped_at_zero(self) -> None:
+        self.assertTrue(change_resources(self.profile.id, ResourcesEventReason.LESSON_FINISH, energy=-7))
+
+        self.resources.refresh_from_db()
+        self.assertEqual(self.resources.energy_amount, 0)
+        self.assertEqual(self.profile.resources_events.get().energy_delta, -5)
+
+    def test_old_events_are_compacted(self) -> None:
+        for money in (10, 20):
+            change_resources(self.profile.id, ResourcesEventReason.UNIT, money=money)
+        change_resources(self.profile.id, ResourcesEventReason.UNIT, money=30)
+
+        old_created_at = timezone.now() - timedelta(days=settings.RESOURCES_EVENTS_COMPACT_AFTER_DAYS + 1)
+        self.profile.resources_events.filter(money_delta__lt=30).update(created_at=old_created_at)
+
+        compact_resources_events()
+
+        events = list(self.profile.resources_events.values_list("reason", "money_delta"))
+        self.assertEqual(events, [(ResourcesEventReason.COMPACTED, 30), (ResourcesEventReason.UNIT, 30)])
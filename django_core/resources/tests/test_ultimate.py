@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+
+from accounts.models import Profile
+from lessons.models import Course
+from resources.utils import check_ultimate_is_active, deactivate_expired_ultimates
+
+
+class UltimateExpiryTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = Course.objects.create(name="test", description="test")
+        cls.active_profile = Profile.objects.create(
+            course=cls.course, ultimate_activated=True,
+            ultimate_finish_datetime=timezone.now() + timedelta(hours=1)
+        )
+        cls.expired_profile = Profile.objects.create(
+            course=cls.course, ultimate_activated=True,
+            ultimate_finish_datetime=timezone.now() - timedelta(seconds=1)
+        )
+
+    def test_ultimate_is_checked_without_writes(self) -> None:
+        with self.assertNumQueries(0):
+            self.assertTrue(check_ultimate_is_active(self.active_profile))
+            self.assertFalse(check_ultimate_is_active(self.expired_profile))
+
+    def test_expired_ultimates_are_deactivated_with_one_update(self) -> None:
+        with self.assertNumQueries(1):
+            self.assertEqual(deactivate_expired_ultimates(), 1)
+
+        self.expired_profile.refresh_from_db()
+        self.assertFalse(self.expired_profile.ultimate_activated)
+        self.assertIsNone(self.expired_profile.ultimate_finish_datetime)
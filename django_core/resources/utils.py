@@ -2,8 +2,16 @@ import logging
 
 import datetime as dt
 
+from django.db import connection, transaction
+from django.db.models import (
+    Case, CharField, DateTimeField, Expression, ExpressionWrapper, F, IntegerField, OuterRef, Subquery, Value, When
+)
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
+
 from accounts.choices import UniversityPosition
 from accounts import models
+from resources.models import Resources, ResourcesEvent, ResourcesEventReason
 
 logger = logging.Logger(__file__)
 
@@ -30,39 +38,264 @@ def get_max_energy_by_position(position: str) -> int:
     return POSITION_ENERGY_MAX_DATA[position]
 
 
+def get_energy_refill_dt() -> dt.datetime:
+    """
+        Момент последнего восполнения энергии - полночь текущего дня
+    """
+    return timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def refill_energy(resources: Resources) -> Resources:
+    """
+        Ленивое восполнение энергии до максимума должности.
+        Энергия восполняется при первом обращении после полуночи, а не ночной задачей,
+        изменение ресурсов восполняет ее само (см. change_resources)
+    """
+    if resources.energy_refilled_at >= get_energy_refill_dt():
+        return resources
+
+    _change_resources(resources.user_id, ResourcesEventReason.ENERGY_REFILL, {}, {})
+
+    resources.refresh_from_db(fields=["energy_amount", "energy_refilled_at"])
+    return resources
+
+
+def _get_position_max_energy(position_field: str) -> Case:
+    return Case(
+        *[When(**{position_field: position}, then=Value(value)) for position, value in POSITION_ENERGY_MAX_DATA.items()],
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+
+def refill_energy_for_all() -> int:
+    """
+        Восполняет энергию всем профилям, к которым еще не обращались после полуночи.
+        Восполнение пишется в журнал одним INSERT ... SELECT, ресурсы обновляются одним UPDATE
+    """
+    refill_dt = get_energy_refill_dt()
+    refilled_at = timezone.now()
+
+    events = (
+        Resources.objects
+        .filter(energy_refilled_at__lt=refill_dt)
+        .annotate(max_energy=_get_position_max_energy("user__university_position"))
+        .filter(energy_amount__lt=F("max_energy"))
+        .annotate(
+            event_profile_id=F("user_id"),
+            event_reason=Value(ResourcesEventReason.ENERGY_REFILL.value, output_field=CharField()),
+            event_time_delta=Value(0, output_field=IntegerField()),
+            event_money_delta=Value(0, output_field=IntegerField()),
+            event_energy_delta=ExpressionWrapper(F("max_energy") - F("energy_amount"), output_field=IntegerField()),
+            event_created_at=Value(refilled_at, output_field=DateTimeField()),
+        )
+        .values(
+            "event_profile_id", "event_reason", "event_time_delta",
+            "event_money_delta", "event_energy_delta", "event_created_at",
+        )
+    )
+    events_sql, events_params = events.query.sql_with_params()
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {ResourcesEvent._meta.db_table} "
+                f"(profile_id, reason, time_delta, money_delta, energy_delta, created_at) {events_sql}",
+                events_params
+            )
+
+        return Resources.objects.filter(energy_refilled_at__lt=refill_dt).update(
+            energy_amount=Greatest(
+                F("energy_amount"),
+                Subquery(
+                    models.Profile.objects
+                    .filter(id=OuterRef("user_id"))
+                    .values(max_energy=_get_position_max_energy("university_position"))
+                ),
+                output_field=IntegerField(),
+            ),
+            energy_refilled_at=refilled_at,
+        )
+
+
 def get_salary_by_position(position: str) -> int:
     position = UniversityPosition(position)
     return POSITION_SALARY[position]
 
 
 def check_ultimate_is_active(profile: "models.Profile") -> bool:
+    """
+        Ультимейт активен, пока не наступило время окончания.
+        Флаг ultimate_activated не учитывается - его сбрасывает периодическая задача
+    """
     finish_dt = profile.ultimate_finish_datetime
+    return finish_dt is not None and finish_dt > timezone.now()
 
-    if not finish_dt and profile.ultimate_activated:
-        logger.warning("ultimate was not activated while finish_dt exists")
-        profile.ultimate_activated = False
-        profile.save()
 
-    if not profile.ultimate_activated:
-        return False
-
-    return finish_dt > dt.datetime.now().replace(
-        tzinfo=finish_dt.astimezone().tzinfo
-    )
+def deactivate_expired_ultimates() -> int:
+    """
+        Сбрасывает флаги истекших ультимейтов одним UPDATE
+    """
+    return models.Profile.objects.filter(
+        ultimate_activated=True, ultimate_finish_datetime__lte=timezone.now()
+    ).update(ultimate_activated=False, ultimate_finish_datetime=None)
 
 
 def get_ultimate_remaining_time(profile: "models.Profile") -> int:
     if not check_ultimate_is_active(profile):
         return 0
 
-    finish_dt = profile.ultimate_finish_datetime
-    tz_info = finish_dt.astimezone().tzinfo
-
-    time_remaining: dt.timedelta = finish_dt - dt.datetime.now().replace(
-        tzinfo=tz_info
-    )
+    time_remaining: dt.timedelta = profile.ultimate_finish_datetime - timezone.now()
     return time_remaining.seconds
 
 
 def get_ultimate_finish_dt(ultimate_duration: int) -> dt.datetime:
-    return dt.datetime.now() + dt.timedelta(seconds=ultimate_duration)
+    return timezone.now() + dt.timedelta(seconds=ultimate_duration)
+
+
+RESOURCES_AMOUNT_FIELDS = ("time_amount", "money_amount", "energy_amount")
+
+
+def _get_resources_updates(
+    *,
+    time: int = 0,
+    money: int = 0,
+    energy: int = 0,
+    min_energy: int = None,
+    max_energy: int = None,
+    strict: bool = False,
+) -> tuple[dict[str, Expression], dict[str, int]]:
+    """
+        Выражения UPDATE и условия WHERE для изменения ресурсов. Значения ограничиваются в SQL:
+        не уходят ниже нуля, энергия поднимается до min_energy и ограничивается max_energy (если она меняется).
+        Если strict - вместо ограничения нулем в WHERE проверяется, что ресурсов хватает
+    """
+    updates = {}
+    filters = {}
+
+    for field, delta in zip(RESOURCES_AMOUNT_FIELDS, (time, money, energy)):
+        value = F(field) + delta
+
+        if delta < 0 and strict:
+            filters[f"{field}__gte"] = -delta
+        elif delta < 0:
+            value = Greatest(value, 0)
+
+        if field == "energy_amount" and min_energy is not None:
+            value = Greatest(value, min_energy)
+
+        if field == "energy_amount" and max_energy is not None and delta:
+            value = Least(value, max_energy)
+
+        if delta or (field == "energy_amount" and min_energy is not None):
+            updates[field] = value
+
+    return updates, filters
+
+
+def _record_applied_changes(reason: ResourcesEventReason, amounts: dict[str, int]) -> None:
+    """
+        Пишет в журнал изменения, примененные UPDATE: разницу между текущими значениями строки
+        (до конца транзакции ее держит UPDATE) и прочитанными до него. Нулевое изменение не пишется
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {ResourcesEvent._meta.db_table}
+                (profile_id, reason, time_delta, money_delta, energy_delta, created_at)
+            SELECT user_id, %s, time_amount - %s, money_amount - %s, energy_amount - %s, %s
+            FROM {Resources._meta.db_table}
+            WHERE id = %s AND (time_amount <> %s OR money_amount <> %s OR energy_amount <> %s)
+            """,
+            [
+                str(reason),
+                *(amounts[field] for field in RESOURCES_AMOUNT_FIELDS),
+                connection.ops.adapt_datetimefield_value(timezone.now()),
+                amounts["id"],
+                *(amounts[field] for field in RESOURCES_AMOUNT_FIELDS),
+            ]
+        )
+
+
+def change_resources(
+    profile_id: int,
+    reason: ResourcesEventReason,
+    *,
+    time: int = 0,
+    money: int = 0,
+    energy: int = 0,
+    min_energy: int = None,
+    max_energy: int = None,
+    strict: bool = False,
+) -> bool:
+    """
+        Изменяет ресурсы профиля одним UPDATE без блокировки строки и пишет в журнал примененные изменения,
+        поэтому по журналу балансы восстанавливаются точно (см. _change_resources).
+        Если strict - при нехватке ресурсов ничего не меняется и возвращается False
+    """
+    if not (time or money or energy or min_energy is not None):
+        return True
+
+    updates, filters = _get_resources_updates(
+        time=time, money=money, energy=energy,
+        min_energy=min_energy, max_energy=max_energy, strict=strict,
+    )
+
+    return _change_resources(profile_id, reason, updates, filters)
+
+
+def _get_resources_row(profile_id: int) -> dict | None:
+    return (
+        Resources.objects
+        .filter(user_id=profile_id)
+        .values("id", *RESOURCES_AMOUNT_FIELDS, "energy_refilled_at", "user__university_position")
+        .first()
+    )
+
+
+def _refill_energy(amounts: dict[str, int], position: str, refill_dt: dt.datetime) -> None:
+    max_energy = POSITION_ENERGY_MAX_DATA.get(position, 0)
+
+    if Resources.objects.filter(**amounts, energy_refilled_at__lt=refill_dt).update(
+        energy_amount=Greatest(F("energy_amount"), max_energy),
+        energy_refilled_at=timezone.now(),
+    ):
+        _record_applied_changes(ResourcesEventReason.ENERGY_REFILL, amounts)
+
+
+def _change_resources(
+    profile_id: int,
+    reason: ResourcesEventReason,
+    updates: dict[str, Expression],
+    filters: dict[str, int],
+) -> bool:
+    """
+        Применяет UPDATE из _get_resources_updates к прочитанным перед ним значениям,
+        если их успели изменить - читает заново и повторяет.
+        Энергия, не восполненная после полуночи, сначала восполняется отдельной записью журнала
+    """
+    refill_dt = get_energy_refill_dt()
+
+    with transaction.atomic():
+        row = _get_resources_row(profile_id)
+
+        while row is not None:
+            amounts = {field: row[field] for field in ("id", *RESOURCES_AMOUNT_FIELDS)}
+
+            if row["energy_refilled_at"] < refill_dt:
+                _refill_energy(amounts, row["user__university_position"], refill_dt)
+            elif not updates:
+                return True
+            elif Resources.objects.filter(**amounts, **filters).update(**updates):
+                _record_applied_changes(reason, amounts)
+                return True
+
+            current_row = _get_resources_row(profile_id)
+
+            # значения не менялись - UPDATE не прошел условие strict
+            if current_row == row:
+                return False
+
+            row = current_row
+
+    return False
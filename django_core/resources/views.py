@@ -4,6 +4,9 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from drf_yasg.utils import swagger_auto_schema
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 
 from accounts.models import Profile
 from resources.exceptions import (
@@ -12,12 +15,12 @@ from resources.exceptions import (
     NotEnoughMoneyException,
     NegativeResourcesException
 )
-from resources.models import Resources
+from resources.models import Resources, ResourcesEventReason
 from resources.serializers import ResourcesSerializer, ResourcesUpdateSerializer
-from resources.tasks import deactivate_ultimate
 from resources.utils import (
-    check_ultimate_is_active,
-    get_ultimate_finish_dt
+    get_ultimate_finish_dt,
+    change_resources,
+    refill_energy
 )
 from helpers.swagger_factory import SwaggerFactory
 
@@ -34,8 +37,8 @@ class ResourcesViewSet(viewsets.GenericViewSet):
 
     @decorators.action(methods=["GET"], detail=False, url_path="retrieve")
     def retrieve_resources(self, request: Request, *args: tuple, **kwargs: dict) -> Response:
-        profile: Profile = request.user.profile.get(course_id=1)
-        serializer: ResourcesSerializer = self.get_serializer_class()(instance=profile.resources)
+        profile: Profile = request.profile
+        serializer: ResourcesSerializer = self.get_serializer_class()(instance=refill_energy(profile.resources))
         return Response(data=serializer.data, status=status.HTTP_200_OK)
 
     @swagger_auto_schema(**SwaggerFactory()(
@@ -46,11 +49,11 @@ class ResourcesViewSet(viewsets.GenericViewSet):
     ))
     @decorators.action(methods=["PATCH"], detail=False, url_path="update")
     def update_resources(self, request: Request, *args: tuple, **kwargs: dict) -> Response:
-        profile: Profile = request.user.profile.get(course_id=1)
+        profile: Profile = request.profile
 
         serializer: ResourcesUpdateSerializer = self.get_serializer_class()(
             data=request.data,
-            instance=profile.resources
+            instance=refill_energy(profile.resources)
         )
         serializer.is_valid(raise_exception=True)
         instance = serializer.save()
@@ -65,21 +68,26 @@ class ResourcesViewSet(viewsets.GenericViewSet):
     ))
     @decorators.action(methods=["POST"], detail=False, url_path="ultimate/activate")
     def activate_ultimate(self, request: Request, *args: tuple, **kwargs: dict) -> Response:
-        profile: Profile = request.user.profile.get(course_id=1)
+        profile: Profile = request.profile
         resources = profile.resources
 
-        if check_ultimate_is_active(profile):
-            raise UltimateAlreadyActivatedException("You have already activated ultimate")
+        finish_dt = get_ultimate_finish_dt(settings.ULTIMATE_DURATION)
 
-        if (remains := resources.money_amount - settings.ULTIMATE_COST) < 0:
-            raise NotEnoughMoneyException("You don't have enough money to activate ultimate")
+        with transaction.atomic():
+            # время окончания ставится только если предыдущий ультимейт истек, повторная активация не пройдет
+            is_activated = Profile.objects.filter(
+                Q(ultimate_finish_datetime__isnull=True) | Q(ultimate_finish_datetime__lte=timezone.now()),
+                id=profile.id
+            ).update(ultimate_activated=True, ultimate_finish_datetime=finish_dt)
 
-        resources.money_amount = remains
-        resources.save()
+            if not is_activated:
+                raise UltimateAlreadyActivatedException("You have already activated ultimate")
+
+            if not change_resources(profile.id, ResourcesEventReason.ULTIMATE, money=-settings.ULTIMATE_COST, strict=True):
+                raise NotEnoughMoneyException("You don't have enough money to activate ultimate")
 
         profile.ultimate_activated = True
-        profile.ultimate_finish_datetime = get_ultimate_finish_dt(settings.ULTIMATE_DURATION)
-        profile.save()
+        profile.ultimate_finish_datetime = finish_dt
+        resources.refresh_from_db(fields=["money_amount"])
 
-        deactivate_ultimate.apply_async(args=[profile.id], countdown=settings.ULTIMATE_DURATION)
         return Response(ResourcesSerializer(resources).data)
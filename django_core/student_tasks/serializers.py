@@ -1,9 +1,10 @@
 from rest_framework import serializers
 from lessons.models import ProfileLessonChunk
-from lessons.structures.tasks import TaskBlock
+from lessons.structures.tasks import TaskBlock, TASK_MODELS
 from accounts.models import Profile
 from lessons.models import Unit
 from student_tasks.models import StudentTaskAnswer
+from helpers.lesson_tree import get_lesson_units_tree
 
 
 class StudentTaskAnswerSerializer(serializers.ModelSerializer):
@@ -14,15 +15,30 @@ class StudentTaskAnswerSerializer(serializers.ModelSerializer):
         model = StudentTaskAnswer
         fields = ["id", "answer", "is_correct", "details"]
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._tasks: dict[int, TaskBlock] = {}
+
     def _get_task(self, task_unit: Unit) -> TaskBlock:
-        task_models = {t_model.type.value: t_model for t_model in TaskBlock.get_all_subclasses()}
-        task_model = task_models[task_unit.type]
-        task_instance = task_model.objects.filter(id=task_unit.content['id']).only().first()
+        """
+            Задание берется из скомпилированного урока: там данные для проверки ответа уже подготовлены
+        """
+        if task_unit.id in self._tasks:
+            return self._tasks[task_unit.id]
+
+        task_instance = None
+
+        if task_unit.lesson_id is not None:
+            task_instance = get_lesson_units_tree(task_unit.lesson).get_task(task_unit.local_id)
+
+        if task_instance is None:
+            task_instance = TASK_MODELS[task_unit.type].objects.filter(id=task_unit.content['id']).first()
 
+        self._tasks[task_unit.id] = task_instance
         return task_instance
 
     def _get_profile(self, task_unit: Unit) -> Profile:
-        profile: Profile = self.context['request'].user.profile.get(course_id=1)
+        profile: Profile = self.context['request'].profile
         return profile
 
     def get_details(self, obj: StudentTaskAnswer) -> dict:
@@ -43,8 +59,14 @@ class StudentTaskAnswerSerializer(serializers.ModelSerializer):
 
         ############
 
-        profile_lesson_chunk = ProfileLessonChunk.objects.filter(unit_id=instance.task.local_id).first()
-        if profile_lesson_chunk is not None:
+        profile_lesson_chunk = ProfileLessonChunk.objects.filter(
+            lesson__player=profile, unit_id=instance.task.local_id
+        ).first()
+        if profile_lesson_chunk is not None and profile_lesson_chunk.content_version:
+            # чанк хранится ссылкой на урок, ответ пишется только в данные игрока
+            profile_lesson_chunk.delta = {**profile_lesson_chunk.delta, 'answer': validated_data['answer']}
+            profile_lesson_chunk.save(update_fields=['delta'])
+        elif profile_lesson_chunk is not None:
             content = profile_lesson_chunk.content
             content['answer'] = validated_data['answer']
             profile_lesson_chunk.content = content
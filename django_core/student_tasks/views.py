@@ -16,15 +16,17 @@ class StudentTaskViewSet(viewsets.GenericViewSet, mixins.RetrieveModelMixin, mix
     def get_object(self) -> StudentTaskAnswer:
         pk = self.kwargs["pk"]
 
-        unit = Unit.objects.filter(local_id=pk)
-        if not unit.exists():
+        unit = Unit.objects.select_related("lesson__content").filter(local_id=pk).first()
+        if unit is None:
             raise UnitNotFoundException(f"Unit with id {pk} not found")
 
-        profile = self.request.user.profile.get()
+        profile = self.request.profile
         instance, created = StudentTaskAnswer.objects.get_or_create(
             profile=profile,
-            task=unit.first()
+            task=unit
         )
+        # get_or_create не переносит загруженный юнит в найденный ответ
+        instance.task = unit
 
         return instance
 